@@ -0,0 +1,150 @@
+# Benchmark del motor de informes TMERT sobre matrices sintéticas (generador_matricesTMERT).
+# Uso:
+#   python benchmark_informesTMERT.py --tamanos 10 100 1000 5000 --salida resultados.json
+#   python benchmark_informesTMERT.py --linea-base linea_base.json --umbral 0.2   (falla si algo empeora > 20 %)
+#   python benchmark_informesTMERT.py --guardar-linea-base linea_base.json
+# Cada tamaño se mide en un proceso nuevo (spawn) para que el pico de RSS sea el de ese tamaño y no el
+# acumulado. Etapas: parseo (todos los agentes), enriquecimiento, filtro (contexto de cada agente con
+# plantilla) y render de cada plantilla de MAPEO_AGENTE_A_PLANTILLA.
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from motor_informesTMERT import (
+    excel_a_estructura_json, procesar_y_enriquecer_datos, construir_contexto_informe, generar_docx_en_memoria,
+    obtener_registro_plantillas, MAPEO_AGENTE_A_PLANTILLA, NOMBRE_AGENTE_POR_CLAVE, normalize_key
+)
+from diagnostico_informesTMERT import MedicionEtapas
+from generador_matricesTMERT import generar_matriz, parsear_mezcla
+
+TAMANOS_POR_DEFECTO = [10, 100, 1000, 5000]
+ETAPAS_BENCHMARK = ["parseo", "enriquecimiento", "filtro", "render"]
+# Diferencias menores a esto no cuentan como regresión (etapas de pocos ms varían +50 % por ruido). Para los
+# tiempos además se tolera FACTOR_RUIDO veces la dispersión (mediana - mínimo entre repeticiones) de la línea
+# base o de la ejecución actual: en una máquina ruidosa el umbral solo detecta cambios mayores que ese ruido.
+TOLERANCIA_ABSOLUTA = {"ms": 20.0, "mb": 5.0}
+FACTOR_RUIDO = 2
+DATOS_MANUALES_BENCHMARK = {"numero_informe_tecnico": "BENCH-001", "nombre_ergonomo": "Ergónomo Benchmark"}
+
+def _pico_rss_mb():
+    # ru_maxrss viene en KB en Linux y en bytes en macOS
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(pico / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def _verificar_niveles(datos_crudos, niveles_esperados):
+    leidos = {str(puesto["n°"]): puesto["niveles_riesgo_agentes"] for puesto in datos_crudos["puestos_trabajo_detalle"]}
+    if leidos != niveles_esperados:
+        distintos = [nro for nro in niveles_esperados if leidos.get(nro) != niveles_esperados[nro]]
+        raise AssertionError(f"El parseo no coincide con la matriz generada: {len(leidos)} puestos leídos de {len(niveles_esperados)}; puestos distintos: {distintos[:10]}")
+
+def medir_tamano(n_puestos, mezcla, semilla, repeticiones):
+    # Se ejecuta en un proceso nuevo: genera la matriz, la mide `repeticiones` veces y se queda con el mínimo por etapa
+    with tempfile.TemporaryDirectory(prefix="bench_tmert_") as directorio:
+        ruta_excel = os.path.join(directorio, f"matriz_{n_puestos}.xlsx")
+        niveles_esperados = generar_matriz(ruta_excel, n_puestos, mezcla, semilla)
+        registro = obtener_registro_plantillas()
+        registro.precargar(MAPEO_AGENTE_A_PLANTILLA.values()) # Compilar plantillas no es parte del render medido
+        agentes = [NOMBRE_AGENTE_POR_CLAVE[clave_agente] for clave_agente in MAPEO_AGENTE_A_PLANTILLA]
+        tiempos = {etapa: [] for etapa in ETAPAS_BENCHMARK}
+        bytes_informes = 0
+        for _ in range(repeticiones):
+            gc.collect() # Que la basura del render anterior no se cobre en el parseo de esta repetición
+            medicion = MedicionEtapas(f"benchmark_{n_puestos}", memoria=False, emitir_log=False)
+            with medicion.etapa("parseo"):
+                with open(ruta_excel, "rb") as archivo_excel:
+                    datos_crudos = excel_a_estructura_json(archivo_excel, informar=lambda nivel, mensaje: None)
+            _verificar_niveles(datos_crudos, niveles_esperados)
+            with medicion.etapa("enriquecimiento"):
+                datos_enriquecidos = procesar_y_enriquecer_datos(datos_crudos)
+            with medicion.etapa("filtro"):
+                contextos = {agente: construir_contexto_informe(datos_enriquecidos, agente, DATOS_MANUALES_BENCHMARK) for agente in agentes}
+            with medicion.etapa("render"):
+                bytes_informes = 0
+                for agente, contexto_render in contextos.items():
+                    docx_buffer = generar_docx_en_memoria(registro.nueva_instancia(MAPEO_AGENTE_A_PLANTILLA[normalize_key(agente)]), contexto_render, informar=lambda nivel, mensaje: None)
+                    if docx_buffer is None:
+                        raise RuntimeError(f"No se pudo renderizar el informe de {agente}.")
+                    bytes_informes += len(docx_buffer.getvalue())
+            medicion.finalizar()
+            for registro_etapa in medicion.resumen():
+                tiempos[registro_etapa["etapa"]].append(registro_etapa["duracion_ms"])
+        return {
+            "puestos": n_puestos,
+            "tamano_excel_kb": round(os.path.getsize(ruta_excel) / 1024, 1),
+            "tiempos_ms": {etapa: min(valores) for etapa, valores in tiempos.items()},
+            "dispersion_ms": {etapa: round(statistics.median(valores) - min(valores), 2) for etapa, valores in tiempos.items()},
+            "total_ms": round(sum(min(valores) for valores in tiempos.values()), 2),
+            "pico_rss_mb": _pico_rss_mb(),
+            "bytes_informes": bytes_informes
+        }
+
+def ejecutar_benchmark(tamanos, mezcla=None, semilla=0, repeticiones=1):
+    resultados = []
+    contexto_spawn = multiprocessing.get_context("spawn")
+    for n_puestos in tamanos:
+        with ProcessPoolExecutor(max_workers=1, mp_context=contexto_spawn) as executor:
+            resultado = executor.submit(medir_tamano, n_puestos, mezcla, semilla, repeticiones).result()
+        resultados.append(resultado)
+        tiempos = " ".join(f"{etapa}={resultado['tiempos_ms'][etapa]:.0f}ms" for etapa in ETAPAS_BENCHMARK)
+        print(f"{n_puestos:>6} puestos: {tiempos} total={resultado['total_ms']:.0f}ms rss={resultado['pico_rss_mb']}MB", flush=True)
+    return {"fecha": datetime.now().isoformat(), "python": platform.python_version(), "plataforma": platform.platform(), "mezcla": mezcla, "semilla": semilla, "repeticiones": repeticiones, "resultados": resultados}
+
+def comparar_con_linea_base(resultado_actual, linea_base, umbral):
+    # Devuelve las regresiones: métricas que superan la línea base en más de `umbral` (0.2 = 20 %)
+    regresiones = []
+    base_por_tamano = {resultado["puestos"]: resultado for resultado in linea_base["resultados"]}
+    for resultado in resultado_actual["resultados"]:
+        base = base_por_tamano.get(resultado["puestos"])
+        if base is None:
+            continue
+        ruido_por_etapa = {etapa: FACTOR_RUIDO * max(resultado.get("dispersion_ms", {}).get(etapa, 0), base.get("dispersion_ms", {}).get(etapa, 0)) for etapa in ETAPAS_BENCHMARK}
+        metricas = [(f"tiempos_ms.{etapa}", resultado["tiempos_ms"][etapa], base["tiempos_ms"].get(etapa), ruido_por_etapa[etapa]) for etapa in ETAPAS_BENCHMARK]
+        # total_ms no se compara: es la suma de las etapas ya comparadas y solo agregaría falsos positivos
+        metricas.append(("pico_rss_mb", resultado["pico_rss_mb"], base.get("pico_rss_mb"), 0))
+        for metrica, valor, valor_base, ruido in metricas:
+            tolerancia = max(TOLERANCIA_ABSOLUTA["mb" if metrica.endswith("_mb") else "ms"], ruido)
+            if valor_base and valor > valor_base * (1 + umbral) and valor - valor_base > tolerancia:
+                regresiones.append({"puestos": resultado["puestos"], "metrica": metrica, "linea_base": valor_base, "actual": valor, "variacion": round(valor / valor_base - 1, 3)})
+    return regresiones
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de parseo, filtros y render del motor TMERT con matrices sintéticas.")
+    parser.add_argument("--tamanos", type=int, nargs="+", default=TAMANOS_POR_DEFECTO, help="Número de puestos de cada matriz (por defecto: 10 100 1000 5000)")
+    parser.add_argument("--mezcla", default=None, help="Pesos por nivel, ej. ACEPTABLE=0.5,INTERMEDIO=0.3,CRÍTICO=0.2")
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--repeticiones", type=int, default=3, help="Se informa el mínimo de cada etapa; con 1 el ruido supera el umbral (por defecto: 3)")
+    parser.add_argument("--salida", help="JSON donde guardar los resultados")
+    parser.add_argument("--linea-base", help="JSON de una ejecución anterior con el que comparar")
+    parser.add_argument("--umbral", type=float, default=0.2, help="Empeoramiento tolerado respecto de la línea base (por defecto: 0.2 = 20 %%)")
+    parser.add_argument("--guardar-linea-base", help="Guarda los resultados como nueva línea base en este JSON")
+    args = parser.parse_args(argv)
+
+    mezcla = parsear_mezcla(args.mezcla) if args.mezcla else None
+    resultado = ejecutar_benchmark(args.tamanos, mezcla, args.semilla, args.repeticiones)
+    for ruta in (args.salida, args.guardar_linea_base):
+        if ruta:
+            with open(ruta, "w", encoding="utf-8") as f_resultado:
+                json.dump(resultado, f_resultado, ensure_ascii=False, indent=2)
+    if not args.linea_base:
+        return 0
+    with open(args.linea_base, encoding="utf-8") as f_linea_base:
+        linea_base = json.load(f_linea_base)
+    regresiones = comparar_con_linea_base(resultado, linea_base, args.umbral)
+    for regresion in regresiones:
+        print(f"REGRESIÓN {regresion['puestos']} puestos {regresion['metrica']}: {regresion['linea_base']} -> {regresion['actual']} (+{regresion['variacion']:.0%})", file=sys.stderr)
+    if regresiones:
+        return 1
+    print(f"Sin regresiones respecto de {args.linea_base} (umbral {args.umbral:.0%}).")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+# Cola de trabajos en segundo plano para la app web (sin Streamlit): una sola cola por proceso, compartida
+# por todas las sesiones. Los trabajos corren en un número fijo de hilos (límite de concurrencia) y además
+# solo empiezan si la memoria estimada de los que están corriendo (más la de los resultados aún no
+# descargados) y la suya caben en limite_memoria_mb.
+# El orden es FIFO: si el primero de la cola no cabe, los demás esperan detrás de él.
+# Los trabajos corren en hilos para que el Excel subido y el resultado no se copien entre procesos; lo que retiene
+# el GIL (el render de los informes del ZIP) lo reparte el trabajo en el pool de procesos de
+# motor_informesTMERT.obtener_pool_render(), que crea la app y no la cola.
+# Configuración por variables de entorno (ver obtener_cola_trabajos):
+#   TMERT_COLA_CONCURRENTES=2    trabajos simultáneos
+#   TMERT_COLA_MEMORIA_MB=2048   memoria estimada máxima de los trabajos simultáneos
+#   TMERT_COLA_MAX_EN_ESPERA=20  trabajos en espera antes de rechazar nuevos
+#   TMERT_COLA_RETENCION_S=3600  segundos que se guarda un resultado no descargado
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from io import BytesIO
+
+from diagnostico_informesTMERT import MedicionEtapas
+from motor_informesTMERT import CONFIG_HOJAS_FACTORES, contar_puestos_xlsx
+
+ESTADO_EN_COLA, ESTADO_PROCESANDO, ESTADO_LISTO, ESTADO_ERROR = "en_cola", "procesando", "listo", "error"
+
+# Memoria estimada de un trabajo según los puestos de la Hoja 2: el render domina y crece con los puestos (en el
+# benchmark, ~0,3 MB por puesto para un informe y ~2,2 veces eso para los 4 del ZIP). No se usa el tamaño del
+# .xlsx porque las matrices reales pesan sobre todo por el formato de las celdas. Si no se pueden contar los
+# puestos se asume el tope.
+MB_BASE_TRABAJO = 50
+MB_POR_PUESTO = 0.3
+MB_MAXIMO_TRABAJO = 1024
+
+def estimar_memoria_mb(contenido_excel, informes=1):
+    puestos = contar_puestos_xlsx(contenido_excel)
+    if puestos is None:
+        return MB_MAXIMO_TRABAJO
+    return min(MB_MAXIMO_TRABAJO, round(MB_BASE_TRABAJO + puestos * MB_POR_PUESTO * (1 + 0.4 * (informes - 1))))
+
+def _tamano_resultado_mb(resultado):
+    # Lo que ocupa un resultado retenido hasta su descarga: sus archivos (bytes o BytesIO) de primer nivel
+    valores = resultado.values() if isinstance(resultado, dict) else [resultado]
+    return sum(len(valor) if isinstance(valor, bytes) else len(valor.getbuffer()) if isinstance(valor, BytesIO) else 0 for valor in valores) / (1024 * 1024)
+
+# Cada cuánto revisa un trabajador desocupado si hay resultados vencidos que descartar
+INTERVALO_LIMPIEZA_S = 60
+
+class ColaLlenaError(RuntimeError):
+    pass
+
+# Avance aproximado (0 a 1) al iniciar cada etapa de MedicionEtapas, y el texto que ve el usuario
+PROGRESO_POR_ETAPA = {
+    "abrir_libro": (0.05, "Abriendo el libro"),
+    "hoja_1": (0.10, "Leyendo hoja 1"),
+    "hoja_2": (0.15, "Leyendo hoja 2"),
+    **{f"hoja_{num_hoja}": (0.15 + 0.05 * posicion, f"Leyendo hoja {num_hoja}") for posicion, num_hoja in enumerate(CONFIG_HOJAS_FACTORES, start=1)},
+    "enriquecimiento": (0.55, "Calculando totales"),
+    "filtro": (0.58, "Aplicando filtros"),
+    "generar_docx": (0.60, "Renderizando informe"),
+    "paquete_zip": (0.60, "Renderizando informes"),
+    "convertir_pdf": (0.85, "Convirtiendo a PDF"),
+}
+
+class Trabajo:
+    def __init__(self, tipo, funcion, args, kwargs, memoria_estimada_mb):
+        self.id = uuid.uuid4().hex[:12]
+        self.tipo = tipo
+        self.memoria_estimada_mb = memoria_estimada_mb
+        self.memoria_resultado_mb = 0
+        self.estado = ESTADO_EN_COLA
+        self.progreso = "En cola"
+        self.fraccion = 0.0
+        self.avisos = [] # (nivel, mensaje) del canal informar() del motor; la app los muestra al terminar
+        self.resultado = None
+        self.error = None
+        self.medicion = None
+        self.descargas = set()
+        self.creado = time.time()
+        self.iniciado = None
+        self.terminado = None
+        self._funcion, self._args, self._kwargs = funcion, args, kwargs
+
+    def informar(self, nivel, mensaje):
+        self.avisos.append((nivel, mensaje))
+
+    def informar_progreso(self, mensaje, fraccion=None):
+        self.progreso = mensaje
+        if fraccion is not None:
+            self.fraccion = max(self.fraccion, fraccion)
+
+    def nueva_medicion(self, nombre, **kwargs):
+        # Se llama dentro del trabajo: MedicionEtapas solo mide en el hilo que la crea
+        self.medicion = MedicionConProgreso(self, nombre, **kwargs)
+        return self.medicion
+
+class MedicionConProgreso(MedicionEtapas):
+    # Además de medir, informa al trabajo el inicio de cada etapa conocida (ej. "hoja_5" -> "Leyendo hoja 5")
+    def __init__(self, trabajo, nombre="ejecucion", **kwargs):
+        super().__init__(nombre, **kwargs)
+        self._trabajo = trabajo
+
+    @contextmanager
+    def etapa(self, nombre, **detalle):
+        if nombre in PROGRESO_POR_ETAPA:
+            fraccion, mensaje = PROGRESO_POR_ETAPA[nombre]
+            self._trabajo.informar_progreso(mensaje, fraccion)
+        with super().etapa(nombre, **detalle):
+            yield
+
+class ColaTrabajos:
+    def __init__(self, max_concurrentes=2, limite_memoria_mb=2048, max_en_espera=20, retencion_s=3600):
+        self.max_concurrentes = max_concurrentes
+        self.limite_memoria_mb = limite_memoria_mb
+        self.max_en_espera = max_en_espera
+        self.retencion_s = retencion_s
+        self._condicion = threading.Condition()
+        self._pendientes = deque()
+        self._trabajos = {} # id -> Trabajo (en cola, procesando o con resultado aún no descargado)
+        self._procesando = 0
+        self._memoria_en_uso_mb = 0 # Estimada de los que corren + resultados retenidos
+        for numero in range(max_concurrentes):
+            threading.Thread(target=self._bucle_trabajador, name=f"cola_tmert_{numero}", daemon=True).start()
+
+    def enviar(self, tipo, funcion, *args, memoria_estimada_mb=0, **kwargs):
+        # funcion(trabajo, *args, **kwargs) corre en un hilo de la cola; lo que devuelva queda en trabajo.resultado
+        with self._condicion:
+            self._descartar_vencidos()
+            if len(self._pendientes) >= self.max_en_espera:
+                raise ColaLlenaError(f"Hay {len(self._pendientes)} trabajos en espera; intente nuevamente en unos minutos.")
+            trabajo = Trabajo(tipo, funcion, args, kwargs, memoria_estimada_mb)
+            self._pendientes.append(trabajo)
+            self._trabajos[trabajo.id] = trabajo
+            self._condicion.notify_all()
+            return trabajo
+
+    def _puede_empezar(self, trabajo):
+        # Un trabajo más grande que el límite corre solo, para que no espere para siempre
+        return self._procesando == 0 or self._memoria_en_uso_mb + trabajo.memoria_estimada_mb <= self.limite_memoria_mb
+
+    def _bucle_trabajador(self):
+        while True:
+            with self._condicion:
+                while not (self._pendientes and self._puede_empezar(self._pendientes[0])):
+                    self._condicion.wait(timeout=INTERVALO_LIMPIEZA_S)
+                    self._descartar_vencidos()
+                trabajo = self._pendientes.popleft()
+                self._procesando += 1
+                self._memoria_en_uso_mb += trabajo.memoria_estimada_mb
+                trabajo.estado, trabajo.iniciado = ESTADO_PROCESANDO, time.time()
+                trabajo.informar_progreso("Iniciando")
+            try:
+                trabajo.resultado = trabajo._funcion(trabajo, *trabajo._args, **trabajo._kwargs)
+                trabajo.estado = ESTADO_LISTO
+                trabajo.informar_progreso("Listo", 1.0)
+            except Exception as e:
+                traceback.print_exc()
+                trabajo.error = str(e)
+                trabajo.estado = ESTADO_ERROR
+                trabajo.informar_progreso("Error")
+            finally:
+                trabajo._funcion, trabajo._args, trabajo._kwargs = None, (), {} # Suelta el Excel subido
+                with self._condicion:
+                    self._procesando -= 1
+                    self._memoria_en_uso_mb -= trabajo.memoria_estimada_mb
+                    trabajo.terminado = time.time()
+                    if trabajo.id not in self._trabajos: # La sesión lo liberó mientras corría
+                        trabajo.resultado = None
+                    elif trabajo.resultado is not None:
+                        trabajo.memoria_resultado_mb = _tamano_resultado_mb(trabajo.resultado)
+                        self._memoria_en_uso_mb += trabajo.memoria_resultado_mb
+                    self._condicion.notify_all()
+
+    def obtener(self, trabajo_id):
+        with self._condicion:
+            return self._trabajos.get(trabajo_id)
+
+    def posicion(self, trabajo):
+        # 1 = el próximo en empezar; 0 si ya no está en espera
+        with self._condicion:
+            try:
+                return self._pendientes.index(trabajo) + 1
+            except ValueError:
+                return 0
+
+    def marcar_descargado(self, trabajo_id, archivo, archivos_totales):
+        # El resultado se libera cuando se descargaron todos sus archivos
+        with self._condicion:
+            trabajo = self._trabajos.get(trabajo_id)
+            if trabajo is None:
+                return
+            trabajo.descargas.add(archivo)
+            if trabajo.descargas >= set(archivos_totales):
+                self._liberar(trabajo)
+
+    def liberar(self, trabajo_id):
+        # Cancela un trabajo en espera o descarta su resultado (ej. la sesión envió uno nuevo)
+        with self._condicion:
+            trabajo = self._trabajos.get(trabajo_id)
+            if trabajo is not None:
+                self._liberar(trabajo)
+
+    def _liberar(self, trabajo):
+        self._trabajos.pop(trabajo.id, None)
+        if trabajo in self._pendientes:
+            self._pendientes.remove(trabajo)
+        trabajo.resultado = None
+        self._memoria_en_uso_mb -= trabajo.memoria_resultado_mb
+        trabajo.memoria_resultado_mb = 0
+        self._condicion.notify_all() # Puede haber dejado espacio para el primero de la cola
+
+    def _descartar_vencidos(self):
+        limite = time.time() - self.retencion_s
+        for trabajo in [trabajo for trabajo in self._trabajos.values() if trabajo.terminado is not None and trabajo.terminado < limite]:
+            self._liberar(trabajo)
+
+    def estado_general(self):
+        with self._condicion:
+            return {"en_espera": len(self._pendientes), "procesando": self._procesando, "memoria_en_uso_mb": round(self._memoria_en_uso_mb, 1), "max_concurrentes": self.max_concurrentes, "limite_memoria_mb": self.limite_memoria_mb}
+
+_cola_proceso = None
+_lock_cola = threading.Lock()
+
+def obtener_cola_trabajos():
+    # Cola única por proceso, como obtener_registro_plantillas()
+    global _cola_proceso
+    with _lock_cola:
+        if _cola_proceso is None:
+            _cola_proceso = ColaTrabajos(
+                max_concurrentes=int(os.environ.get("TMERT_COLA_CONCURRENTES", "2")),
+                limite_memoria_mb=int(os.environ.get("TMERT_COLA_MEMORIA_MB", "2048")),
+                max_en_espera=int(os.environ.get("TMERT_COLA_MAX_EN_ESPERA", "20")),
+                retencion_s=int(os.environ.get("TMERT_COLA_RETENCION_S", "3600"))
+            )
+        return _cola_proceso
@@ -0,0 +1,148 @@
+# Instrumentación del motor de informes TMERT: tiempo y pico de memoria (tracemalloc) por etapa, líneas
+# de log en JSON y perfil cProfile opcional. No depende de Streamlit.
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+logger_diagnostico = logging.getLogger("informesTMERT.diagnostico")
+
+def configurar_log_diagnostico():
+    # Emite las líneas JSON por stderr, una por etapa. Se puede llamar varias veces.
+    if not logger_diagnostico.handlers:
+        manejador = logging.StreamHandler()
+        manejador.setFormatter(logging.Formatter("%(message)s"))
+        logger_diagnostico.addHandler(manejador)
+        logger_diagnostico.setLevel(logging.INFO)
+        logger_diagnostico.propagate = False
+
+# tracemalloc es global al proceso y tiene un solo contador de pico para todos los hilos: si dos ejecuciones
+# lo usaran a la vez, el reset_peak() de una borraría el pico de la otra. Por eso solo mide memoria una
+# ejecución a la vez (la "dueña", que lo enciende al empezar una etapa de primer nivel sin otras en curso),
+# y una etapa que se solapó con otra ejecución medida queda con pico_memoria_kb=None: su pico incluiría la
+# memoria asignada por la otra.
+_lock_tracemalloc = threading.Lock()
+_duena_tracemalloc = None
+_etapas_raiz_activas = 0 # De todas las mediciones activas, midan memoria o no
+_solapamientos = 0 # Cuántas veces empezó una etapa de primer nivel con otra en curso
+
+def _entrar_etapa_raiz(medicion):
+    # Devuelve True si esta medición queda como dueña de tracemalloc durante la etapa
+    global _duena_tracemalloc, _etapas_raiz_activas, _solapamientos
+    with _lock_tracemalloc:
+        if _etapas_raiz_activas:
+            _solapamientos += 1
+        _etapas_raiz_activas += 1
+        if not medicion.memoria or _duena_tracemalloc is not None or _etapas_raiz_activas > 1:
+            return False
+        _duena_tracemalloc = medicion
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        return True
+
+def _salir_etapa_raiz(medicion):
+    global _duena_tracemalloc, _etapas_raiz_activas
+    with _lock_tracemalloc:
+        _etapas_raiz_activas -= 1
+        if _duena_tracemalloc is medicion:
+            _duena_tracemalloc = None
+            tracemalloc.stop()
+
+def _hubo_solapamiento(marca_solapamientos):
+    # Otra etapa de primer nivel empezó durante la etapa, o sigue en curso al terminarla
+    return _solapamientos != marca_solapamientos or _etapas_raiz_activas > 1
+
+class MedicionEtapas:
+    # Registra cada etapa como {"etapa", "nivel", "duracion_ms", "pico_memoria_kb", ...detalle}.
+    # Las etapas se pueden anidar (ej. "parseo" > "hoja_2"); el pico de una etapa incluye el de sus hijas.
+    # Con activa=False no mide nada (es lo que usan por defecto las funciones del motor).
+    # Con la variable de entorno TMERT_CPROFILE=<carpeta> además se perfila todo hasta finalizar() y se
+    # guarda <carpeta>/<nombre>_<id_ejecucion>.prof (abrir con snakeviz o pstats).
+    def __init__(self, nombre="ejecucion", activa=True, memoria=True, emitir_log=True):
+        self.nombre = nombre
+        self.activa = activa
+        self.memoria = activa and memoria
+        self.emitir_log = activa and emitir_log
+        self.id_ejecucion = uuid.uuid4().hex[:12]
+        self.etapas = []
+        self.ruta_perfil = None
+        self._pila = []
+        self._duena_tracemalloc = False
+        # Solo se miden las etapas del hilo que creó la medición: la pila y tracemalloc.reset_peak()
+        # no admiten etapas intercaladas desde hilos de trabajo.
+        self._hilo = threading.current_thread()
+        self._inicio = time.perf_counter()
+        self._perfil = None
+        if activa and os.environ.get("TMERT_CPROFILE"):
+            self._perfil = cProfile.Profile()
+            try:
+                self._perfil.enable()
+            except ValueError: # Ya hay otro perfilador activo en este hilo
+                self._perfil = None
+
+    @contextmanager
+    def etapa(self, nombre, **detalle):
+        if not self.activa or threading.current_thread() is not self._hilo:
+            yield
+            return
+        registro = {"etapa": nombre, "nivel": len(self._pila), "duracion_ms": None, "pico_memoria_kb": None}
+        registro.update(detalle)
+        self.etapas.append(registro)
+        etapa_raiz = not self._pila
+        if etapa_raiz:
+            self._duena_tracemalloc = _entrar_etapa_raiz(self)
+        medir_memoria = self._duena_tracemalloc
+        marca_solapamientos = _solapamientos
+        if medir_memoria:
+            memoria_actual, pico_actual = tracemalloc.get_traced_memory()
+            for marco in self._pila:
+                marco["pico"] = max(marco["pico"], pico_actual)
+            tracemalloc.reset_peak()
+        marco = {"memoria_inicio": memoria_actual if medir_memoria else 0, "pico": 0}
+        self._pila.append(marco)
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            registro["duracion_ms"] = round((time.perf_counter() - inicio) * 1000, 2)
+            self._pila.pop()
+            if medir_memoria:
+                pico_actual = tracemalloc.get_traced_memory()[1]
+                marco["pico"] = max(marco["pico"], pico_actual)
+                for marco_padre in self._pila:
+                    marco_padre["pico"] = max(marco_padre["pico"], pico_actual)
+                if not _hubo_solapamiento(marca_solapamientos):
+                    registro["pico_memoria_kb"] = round(max(marco["pico"] - marco["memoria_inicio"], 0) / 1024, 1)
+            if etapa_raiz:
+                _salir_etapa_raiz(self)
+            if self.emitir_log:
+                logger_diagnostico.info(json.dumps({"evento": "etapa_tmert", "id_ejecucion": self.id_ejecucion, "fecha": datetime.now().isoformat(), **registro}, ensure_ascii=False, default=str))
+
+    def resumen(self):
+        return [dict(registro) for registro in self.etapas]
+
+    def finalizar(self):
+        # Emite la línea de cierre con el total y guarda el perfil cProfile si estaba activo
+        if not self.activa:
+            return
+        if self._perfil is not None:
+            self._perfil.disable()
+            carpeta = os.environ["TMERT_CPROFILE"]
+            try:
+                os.makedirs(carpeta, exist_ok=True)
+                ruta_perfil = os.path.join(carpeta, f"{self.nombre}_{self.id_ejecucion}.prof")
+                self._perfil.dump_stats(ruta_perfil)
+                self.ruta_perfil = ruta_perfil
+            except OSError as e: # Un perfil que no se pudo guardar no debe hacer fallar el informe
+                logger_diagnostico.warning(f"No se pudo guardar el perfil cProfile en '{carpeta}': {e}")
+            self._perfil = None
+        if self.emitir_log:
+            logger_diagnostico.info(json.dumps({"evento": "ejecucion_tmert", "id_ejecucion": self.id_ejecucion, "nombre": self.nombre, "fecha": datetime.now().isoformat(), "duracion_total_ms": round((time.perf_counter() - self._inicio) * 1000, 2), "etapas": len(self.etapas), "perfil": self.ruta_perfil}, ensure_ascii=False))
+
+SIN_MEDICION = MedicionEtapas(activa=False)
@@ -0,0 +1,116 @@
+# Generador de matrices TMERT sintéticas con el diseño exacto que lee excel_a_estructura_json (ACHS v7):
+# celdas de MAPEO_HOJA1 en la Hoja "1", columnas de HOJA2_ENCABEZADOS desde la B en la Hoja "2" y las
+# columnas Q/X (o de riesgo directo) de CONFIG_HOJAS_FACTORES en las hojas "4" a "10".
+# Uso:
+#   python generador_matricesTMERT.py matriz_500.xlsx --puestos 500 --mezcla ACEPTABLE=0.5,INTERMEDIO=0.3,CRÍTICO=0.2
+import argparse
+import random
+
+import openpyxl
+import openpyxl.utils
+
+from motor_informesTMERT import (
+    MAPEO_HOJA1, FILA_INICIO_HOJA2, HOJA2_ENCABEZADOS, CONFIG_HOJAS_FACTORES, COL_NRO_PUESTO, normalize_key
+)
+
+NIVELES_GENERABLES = ["ACEPTABLE", "INTERMEDIO", "CRÍTICO"]
+MEZCLA_POR_DEFECTO = {"ACEPTABLE": 0.5, "INTERMEDIO": 0.3, "CRÍTICO": 0.2}
+
+# Texto que se escribe en la hoja de factores para obtener cada nivel al leerla
+_CELDAS_NIVEL_Q_X = {"ACEPTABLE": ("Aceptable", None), "INTERMEDIO": ("No aceptable", "No crítico"), "CRÍTICO": ("No aceptable", "Crítico")}
+_CELDA_NIVEL_DIRECTO = {"ACEPTABLE": "Aceptable", "INTERMEDIO": "Intermedio", "CRÍTICO": "No aceptable"}
+
+def parsear_mezcla(texto):
+    # "ACEPTABLE=0.5,INTERMEDIO=0.3,CRÍTICO=0.2" -> dict con pesos (se admite CRITICO sin tilde)
+    mezcla = {}
+    for parte in texto.split(","):
+        nivel, _, peso = parte.partition("=")
+        nivel = nivel.strip().upper().replace("CRITICO", "CRÍTICO")
+        if nivel not in NIVELES_GENERABLES:
+            raise ValueError(f"Nivel desconocido en la mezcla: '{nivel}' (use {', '.join(NIVELES_GENERABLES)})")
+        mezcla[nivel] = float(peso)
+    if sum(mezcla.values()) <= 0:
+        raise ValueError("La mezcla de niveles debe tener al menos un peso positivo.")
+    return mezcla
+
+def _fila(valores_por_columna, col_max):
+    # Lista de valores de la columna A a col_max, para WriteOnlyWorksheet.append()
+    fila = [None] * col_max
+    for col_idx, valor in valores_por_columna.items():
+        fila[col_idx - 1] = valor
+    return fila
+
+def generar_matriz(ruta_salida, n_puestos, mezcla=None, semilla=0):
+    # Escribe la matriz y devuelve los niveles esperados: {nro_puesto (str): {clave_agente: nivel}}
+    mezcla = mezcla or MEZCLA_POR_DEFECTO
+    niveles, pesos = list(mezcla.keys()), list(mezcla.values())
+    azar = random.Random(semilla)
+    areas = [f"Área {letra}" for letra in "ABCDEFGH"]
+    puestos = [(str(nro), azar.choice(areas), f"Puesto {nro}") for nro in range(1, n_puestos + 1)]
+
+    wb = openpyxl.Workbook(write_only=True) # Escritura en streaming: 5.000 puestos sin cargar todo en memoria
+
+    # Hoja 1: un valor de ejemplo en cada celda mapeada
+    celdas_h1 = {}
+    for seccion_titulo, campos in MAPEO_HOJA1.items():
+        for etiqueta, (fila_excel, col_excel_char) in campos.items():
+            valor = f"{etiqueta} sintético"
+            if etiqueta.startswith("Nº Trabajadores"):
+                valor = azar.randint(5, 500)
+            celdas_h1.setdefault(fila_excel, {})[openpyxl.utils.column_index_from_string(col_excel_char)] = valor
+    hoja1 = wb.create_sheet("1")
+    col_max_h1 = max(col for celdas in celdas_h1.values() for col in celdas)
+    for fila_idx in range(1, max(celdas_h1) + 1):
+        hoja1.append(_fila(celdas_h1.get(fila_idx, {}), col_max_h1))
+
+    # Hoja 2: caracterización de puestos
+    hoja2 = wb.create_sheet("2")
+    col_max_h2 = COL_NRO_PUESTO + len(HOJA2_ENCABEZADOS) - 1
+    for _ in range(1, FILA_INICIO_HOJA2 - 1):
+        hoja2.append([])
+    hoja2.append(_fila({COL_NRO_PUESTO + i: encabezado for i, encabezado in enumerate(HOJA2_ENCABEZADOS)}, col_max_h2))
+    for nro, area, puesto in puestos:
+        valores = {COL_NRO_PUESTO + i: f"{encabezado} {nro}" for i, encabezado in enumerate(HOJA2_ENCABEZADOS)}
+        valores.update({COL_NRO_PUESTO: int(nro), COL_NRO_PUESTO + 1: area, COL_NRO_PUESTO + 2: puesto})
+        for encabezado in ("N° trab exp hombre", "N° trab exp mujer"):
+            valores[COL_NRO_PUESTO + HOJA2_ENCABEZADOS.index(encabezado)] = azar.randint(0, 30)
+        hoja2.append(_fila(valores, col_max_h2))
+
+    # Hojas de factores: un nivel por puesto según la mezcla
+    niveles_esperados = {nro: {} for nro, _, _ in puestos}
+    for num_hoja, config in CONFIG_HOJAS_FACTORES.items():
+        hoja = wb.create_sheet(num_hoja)
+        col_max = max(config.get("col_riesgo_directo_idx", 0), config.get("col_q_idx", 0), config.get("col_x_idx", 0))
+        for _ in range(1, config["fila_inicio"]):
+            hoja.append([])
+        for nro, area, puesto in puestos:
+            nivel = azar.choices(niveles, weights=pesos)[0]
+            valores = {COL_NRO_PUESTO: int(nro), COL_NRO_PUESTO + 1: area, COL_NRO_PUESTO + 2: puesto}
+            if "col_riesgo_directo_idx" in config:
+                valores[config["col_riesgo_directo_idx"]] = _CELDA_NIVEL_DIRECTO[nivel]
+            else:
+                valor_q, valor_x = _CELDAS_NIVEL_Q_X[nivel]
+                valores[config["col_q_idx"]] = valor_q
+                valores[config["col_x_idx"]] = valor_x
+            hoja.append(_fila(valores, col_max))
+            niveles_esperados[nro][config["nombre_json_agente"]] = nivel
+    wb.save(ruta_salida)
+    return niveles_esperados
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Genera una matriz TMERT sintética (diseño ACHS v7).")
+    parser.add_argument("salida", help="Archivo .xlsx a crear")
+    parser.add_argument("--puestos", type=int, default=100, help="Número de puestos (por defecto: 100)")
+    parser.add_argument("--mezcla", default=None, help="Pesos por nivel, ej. ACEPTABLE=0.5,INTERMEDIO=0.3,CRÍTICO=0.2")
+    parser.add_argument("--semilla", type=int, default=0)
+    args = parser.parse_args(argv)
+    mezcla = parsear_mezcla(args.mezcla) if args.mezcla else None
+    niveles_esperados = generar_matriz(args.salida, args.puestos, mezcla, args.semilla)
+    conteo = {}
+    for niveles_puesto in niveles_esperados.values():
+        nivel = niveles_puesto[normalize_key("Postura")]
+        conteo[nivel] = conteo.get(nivel, 0) + 1
+    print(f"Matriz generada: {args.salida} ({args.puestos} puestos; niveles de Postura: {conteo})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+# Procesamiento por lotes de matrices TMERT (sin Streamlit).
+# Uso:
+#   python lote_informesTMERT.py matrices/ --salida informes_lote --procesos 4
+#   python lote_informesTMERT.py "matrices/2024_T3/*.xlsx" --datos-manuales ergonomo.json --agentes Postura "MMC LDT"
+#   python lote_informesTMERT.py matrices/ --pdf   (además del DOCX, el PDF de cada informe; requiere LibreOffice)
+# Cada matriz se procesa en un proceso de trabajo; los informes se escriben en <salida>/<nombre_matriz>/ (si dos
+# matrices se llaman igual, ej. T3/matriz.xlsx y T4/matriz.xlsx, en <salida>/T3_matriz/ y <salida>/T4_matriz/) y el
+# estado de cada archivo queda en <salida>/manifiesto.json, que se reescribe a medida que termina cada matriz.
+# Un archivo con error no detiene el lote.
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from motor_informesTMERT import (
+    excel_a_estructura_json, procesar_y_enriquecer_datos, generar_informes_por_agente, convertir_informes_a_pdf,
+    obtener_registro_plantillas, MAPEO_AGENTE_A_PLANTILLA, NOMBRE_AGENTE_POR_CLAVE, normalize_key
+)
+from diagnostico_informesTMERT import MedicionEtapas
+from pdf_informesTMERT import obtener_pool_pdf, pdf_disponible, ErrorConversionPDF
+
+# --- Búsqueda de matrices a partir de carpetas, globs o archivos ---
+def buscar_matrices(entradas):
+    rutas = []
+    for entrada in entradas:
+        if os.path.isdir(entrada):
+            candidatas = glob.glob(os.path.join(entrada, "*.xlsx"))
+        else:
+            candidatas = glob.glob(entrada) or [entrada]
+        # Se descartan los archivos temporales que deja Excel al tener la matriz abierta ("~$...")
+        rutas.extend(ruta for ruta in sorted(candidatas) if not os.path.basename(ruta).startswith("~$"))
+    return list(dict.fromkeys(rutas))
+
+def directorios_de_salida(rutas):
+    # Nombre de la carpeta de salida de cada matriz: su nombre sin extensión, o, si otra matriz del lote se llama
+    # igual, su ruta relativa a la carpeta común de las que chocan (T3/matriz.xlsx -> "T3_matriz"). Se compara
+    # sin distinguir mayúsculas porque en Windows y macOS "Matriz" y "matriz" son la misma carpeta.
+    por_nombre = {}
+    for ruta in rutas:
+        por_nombre.setdefault(os.path.splitext(os.path.basename(ruta))[0].lower(), []).append(ruta)
+    directorios, usados = {}, set()
+    for ruta in rutas:
+        nombre = os.path.splitext(os.path.basename(ruta))[0]
+        repetidas = por_nombre[nombre.lower()]
+        if len(repetidas) > 1:
+            base_comun = os.path.commonpath([os.path.dirname(os.path.abspath(repetida)) for repetida in repetidas])
+            nombre = os.path.splitext(os.path.relpath(os.path.abspath(ruta), base_comun))[0].replace(os.sep, "_")
+        candidato, sufijo = nombre, 2
+        while candidato.lower() in usados: # Ej. "T3_matriz.xlsx" junto a "T3/matriz.xlsx"
+            candidato, sufijo = f"{nombre}_{sufijo}", sufijo + 1
+        usados.add(candidato.lower())
+        directorios[ruta] = candidato
+    return directorios
+
+# --- Trabajo de un proceso: una matriz completa ---
+def procesar_matriz(ruta_excel, directorio_matriz, datos_manuales, agentes=None, pdf=False):
+    inicio = time.perf_counter()
+    estado = {"archivo": ruta_excel, "directorio": directorio_matriz, "estado": "ok", "informes": [], "avisos": [], "error": None}
+    # Solo tiempos (sin tracemalloc) para no encarecer el lote; TMERT_CPROFILE también aplica aquí
+    medicion = MedicionEtapas(f"lote_{os.path.splitext(os.path.basename(ruta_excel))[0]}", memoria=False, emitir_log=False)
+    try:
+        agentes_requeridos = agentes or [NOMBRE_AGENTE_POR_CLAVE[clave_agente] for clave_agente in MAPEO_AGENTE_A_PLANTILLA]
+        with open(ruta_excel, "rb") as archivo_excel:
+            datos_crudos = excel_a_estructura_json(archivo_excel, agentes_requeridos=agentes_requeridos, informar=lambda nivel, mensaje: estado["avisos"].append(f"[{nivel}] {mensaje}"), medicion=medicion)
+        if not datos_crudos:
+            raise ValueError("No se pudo procesar el archivo Excel.")
+        estado["extension_hojas"] = datos_crudos["metadata"]["extension_hojas"]
+        with medicion.etapa("enriquecimiento"):
+            datos_enriquecidos = procesar_y_enriquecer_datos(datos_crudos)
+        os.makedirs(directorio_matriz, exist_ok=True)
+        with medicion.etapa("render_informes", informes=len(agentes_requeridos)):
+            informes = generar_informes_por_agente(datos_enriquecidos, datos_manuales, os.path.basename(ruta_excel), agentes=agentes_requeridos)
+        if pdf:
+            with medicion.etapa("convertir_pdf", informes=len(informes)):
+                pdfs = convertir_informes_a_pdf(informes, obtener_pool_pdf())
+        for indice, (agente, nombre_archivo, n_puestos, informe_bytes, error) in enumerate(informes):
+            registro_informe = {"agente": agente, "puestos_intermedio": n_puestos, "archivo": None, "error": error}
+            if informe_bytes is not None:
+                registro_informe["archivo"] = os.path.join(directorio_matriz, nombre_archivo)
+                with open(registro_informe["archivo"], "wb") as f_informe:
+                    f_informe.write(informe_bytes)
+            else:
+                estado["estado"] = "parcial"
+            if pdf and informe_bytes is not None:
+                nombre_pdf, pdf_bytes, error_pdf = pdfs[indice]
+                registro_informe["archivo_pdf"], registro_informe["error_pdf"] = None, error_pdf
+                if pdf_bytes is not None:
+                    registro_informe["archivo_pdf"] = os.path.join(directorio_matriz, nombre_pdf)
+                    with open(registro_informe["archivo_pdf"], "wb") as f_pdf:
+                        f_pdf.write(pdf_bytes)
+                else:
+                    estado["estado"] = "parcial"
+            estado["informes"].append(registro_informe)
+    except Exception as e:
+        traceback.print_exc()
+        estado["estado"] = "error"
+        estado["error"] = f"{type(e).__name__}: {e}"
+    medicion.finalizar()
+    estado["etapas"] = medicion.resumen()
+    estado["duracion_s"] = round(time.perf_counter() - inicio, 3)
+    return estado
+
+def _inicializar_proceso(pdf=False):
+    # Cada proceso de trabajo compila las plantillas una vez y las reutiliza para todas sus matrices.
+    # Con PDF además arranca su propio soffice (uno por proceso: la concurrencia la da el lote).
+    obtener_registro_plantillas().precargar(MAPEO_AGENTE_A_PLANTILLA.values())
+    if pdf:
+        try:
+            obtener_pool_pdf(procesos=1).precalentar()
+        except ErrorConversionPDF: # Un fallo en el initializer rompería todo el pool; se reintenta al convertir
+            traceback.print_exc()
+
+def _escribir_manifiesto(directorio_salida, estados, pendientes):
+    # Se escribe a un temporal y se reemplaza, para que un lote interrumpido no deje un JSON a medias
+    estados = sorted(estados, key=lambda estado: estado["archivo"])
+    manifiesto = {
+        "fecha_procesamiento": datetime.now().isoformat(),
+        "completo": not pendientes,
+        "total": len(estados) + len(pendientes),
+        "ok": sum(1 for estado in estados if estado["estado"] == "ok"),
+        "con_errores": sum(1 for estado in estados if estado["estado"] != "ok"),
+        "pendientes": sorted(pendientes),
+        "archivos": estados
+    }
+    ruta_manifiesto = os.path.join(directorio_salida, "manifiesto.json")
+    with open(ruta_manifiesto + ".tmp", "w", encoding="utf-8") as f_manifiesto:
+        json.dump(manifiesto, f_manifiesto, ensure_ascii=False, indent=2)
+    os.replace(ruta_manifiesto + ".tmp", ruta_manifiesto)
+    return manifiesto
+
+def procesar_lote(rutas, directorio_salida, datos_manuales, agentes=None, procesos=None, pdf=False):
+    os.makedirs(directorio_salida, exist_ok=True)
+    directorios = directorios_de_salida(rutas)
+    estados, pendientes = [], set(rutas)
+    _escribir_manifiesto(directorio_salida, estados, pendientes)
+    with ProcessPoolExecutor(max_workers=procesos, initializer=_inicializar_proceso, initargs=(pdf,)) as executor:
+        futuros = {executor.submit(procesar_matriz, ruta, os.path.join(directorio_salida, directorios[ruta]), datos_manuales, agentes, pdf): ruta for ruta in rutas}
+        for futuro in as_completed(futuros):
+            try:
+                estado = futuro.result()
+            except Exception as e: # Ej. el proceso de trabajo murió (BrokenProcessPool)
+                estado = {"archivo": futuros[futuro], "directorio": os.path.join(directorio_salida, directorios[futuros[futuro]]), "estado": "error", "informes": [], "avisos": [], "error": f"{type(e).__name__}: {e}"}
+            estados.append(estado)
+            pendientes.discard(futuros[futuro])
+            _escribir_manifiesto(directorio_salida, estados, pendientes)
+            print(f"[{len(estados)}/{len(rutas)}] {estado['estado'].upper():7} {estado['archivo']}", flush=True)
+    return _escribir_manifiesto(directorio_salida, estados, pendientes)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Genera los informes TMERT de un lote de matrices Excel (ACHS v7).")
+    parser.add_argument("entradas", nargs="+", help="Carpetas, patrones glob o archivos .xlsx")
+    parser.add_argument("--salida", default="informes_lote", help="Carpeta de salida (por defecto: informes_lote)")
+    parser.add_argument("--procesos", type=int, default=None, help="Número de procesos de trabajo (por defecto: uno por CPU)")
+    parser.add_argument("--datos-manuales", help="JSON con los datos del ergónomo (numero_informe_tecnico, nombre_ergonomo, ...)")
+    parser.add_argument("--agentes", nargs="+", help="Agentes a informar (por defecto: todos los que tienen plantilla)")
+    parser.add_argument("--pdf", action="store_true", help="Genera también el PDF de cada informe con LibreOffice")
+    args = parser.parse_args(argv)
+
+    datos_manuales = {}
+    if args.datos_manuales:
+        with open(args.datos_manuales, encoding="utf-8") as f_datos:
+            datos_manuales = json.load(f_datos)
+    if args.agentes:
+        sin_plantilla = [agente for agente in args.agentes if normalize_key(agente) not in MAPEO_AGENTE_A_PLANTILLA]
+        if sin_plantilla:
+            parser.error(f"Sin plantilla para: {', '.join(sin_plantilla)}")
+    if args.pdf and not pdf_disponible():
+        parser.error("--pdf requiere LibreOffice (soffice) y su módulo de Python 'uno'; ver TMERT_SOFFICE.")
+
+    rutas = buscar_matrices(args.entradas)
+    if not rutas:
+        print("No se encontraron archivos .xlsx.", file=sys.stderr)
+        return 1
+    manifiesto = procesar_lote(rutas, args.salida, datos_manuales, agentes=args.agentes, procesos=args.procesos, pdf=args.pdf)
+    print(f"Listo: {manifiesto['ok']}/{manifiesto['total']} matrices sin errores. Manifiesto: {os.path.join(args.salida, 'manifiesto.json')}")
+    return 0 if manifiesto["con_errores"] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,973 @@
+# Motor de informes TMERT: lectura de la matriz Excel (ACHS v7), cálculos, filtros por agente y
+# render de las plantillas DOCX. No importa Streamlit, para poder usarse desde la app web
+# (webgen_informesTMERT.py) y desde el procesamiento por lotes (lote_informesTMERT.py).
+import openpyxl
+import openpyxl.utils
+import os
+import hashlib
+import pickle
+import threading
+import copy
+import itertools
+import logging
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import zipfile
+from datetime import datetime
+import traceback
+import re
+import posixpath
+import xml.etree.ElementTree as ET
+from docxtpl import DocxTemplate
+from jinja2 import Environment
+from io import BytesIO
+from diagnostico_informesTMERT import SIN_MEDICION
+
+logger = logging.getLogger("informesTMERT")
+
+# --- Canal de avisos al usuario ---
+# Las funciones del motor reciben informar(nivel, mensaje) con nivel "warning" o "error". La app web
+# lo conecta a st.warning/st.error; por defecto los avisos van al logging.
+def informar_por_log(nivel, mensaje):
+    logger.log(logging.ERROR if nivel == "error" else logging.WARNING, mensaje)
+
+# --- Función para Normalizar Claves ---
+def normalize_key(text):
+    if not isinstance(text, str):
+        text = str(text)
+    text = text.lower()
+    replacements = {
+        " ": "_", "º": "nro", ".": "", ":": "", "ñ": "n", "ó": "o", "ö": "o",
+        "é": "e", "í": "i", "á": "a", "ú": "u", "ü": "u", "-": "_", "(": "", ")": "",
+        "/": "_"
+    }
+    for char, replacement in replacements.items():
+        text = text.replace(char, replacement)
+    text = re.sub(r'_+', '_', text) # Colapsar múltiples guiones bajos
+    return text.strip("_")
+
+# --- Función para Procesar y Enriquecer Datos (Cálculos de Totales) ---
+def procesar_y_enriquecer_datos(datos_crudos):
+    if not datos_crudos:
+        return None
+    datos_procesados = datos_crudos.copy() # Trabajar sobre una copia
+    # Calcular total de trabajadores en el centro de trabajo
+    if "informacion_general" in datos_procesados and "centro_trabajo" in datos_procesados["informacion_general"]:
+        ct = datos_procesados["informacion_general"]["centro_trabajo"]
+        try:
+            hombres_ct = int(ct.get("nnro_trabajadores_hombres", 0) or 0)
+            mujeres_ct = int(ct.get("nnro_trabajadores_mujeres", 0) or 0)
+            ct["total_trabajadores_ct"] = hombres_ct + mujeres_ct
+        except ValueError:
+            ct["total_trabajadores_ct"] = "N/A (Error conversión)"
+    # Calcular total de trabajadores expuestos por cada puesto/caso
+    if "puestos_trabajo_detalle" in datos_procesados:
+        for puesto in datos_procesados["puestos_trabajo_detalle"]:
+            try:
+                hombres_exp = int(puesto.get(normalize_key("N° trab exp hombre"), 0) or 0) # Usar clave normalizada
+                mujeres_exp = int(puesto.get(normalize_key("N° trab exp mujer"), 0) or 0) # Usar clave normalizada
+                puesto["total_trabajadores_expuestos_puesto"] = hombres_exp + mujeres_exp
+            except ValueError:
+                puesto["total_trabajadores_expuestos_puesto"] = "N/A (Error conversión)"
+            except TypeError:
+                 puesto["total_trabajadores_expuestos_puesto"] = "N/A (Error tipo)"
+    return datos_procesados
+
+# --- Registro de plantillas DOCX precompiladas ---
+# Cada plantilla se lee y se prepara una sola vez por proceso: se guardan los bytes del .docx, el XML
+# del cuerpo ya "parcheado" por docxtpl y las plantillas Jinja compiladas. Cada render trabaja sobre
+# una instancia nueva que abre su propia copia del documento, por lo que es seguro entre sesiones.
+# Si el archivo cambia en disco (mtime o tamaño) se vuelve a cargar.
+class _EntornoJinjaPrecompilado(Environment):
+    # docxtpl compila el XML con jinja_env.from_string(); aquí se memoriza el resultado por fuente.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._compiladas = {}
+        self._lock_compiladas = threading.Lock()
+
+    def from_string(self, source, globals=None, template_class=None):
+        if globals is not None or template_class is not None:
+            return super().from_string(source, globals, template_class)
+        plantilla_jinja = self._compiladas.get(source)
+        if plantilla_jinja is None:
+            plantilla_jinja = super().from_string(source)
+            with self._lock_compiladas:
+                self._compiladas[source] = plantilla_jinja
+        return plantilla_jinja
+
+class PlantillaPrecompilada:
+    def __init__(self, ruta):
+        self.ruta = ruta
+        info = os.stat(ruta)
+        self.firma_archivo = (info.st_mtime_ns, info.st_size)
+        with open(ruta, "rb") as f_template:
+            self.contenido = f_template.read()
+        self.entorno_jinja = _EntornoJinjaPrecompilado()
+        doc = DocxTemplate(BytesIO(self.contenido))
+        doc.init_docx()
+        self.xml_cuerpo = doc.patch_xml(doc.get_xml())
+        # Compila el cuerpo de antemano (misma transformación que aplica DocxTemplate.render_xml_part)
+        self.entorno_jinja.from_string(re.sub(r"<w:p([ >])", r"\n<w:p\1", self.xml_cuerpo))
+
+    def nueva_instancia(self):
+        return _DocxTemplateDesdeRegistro(self)
+
+class _DocxTemplateDesdeRegistro(DocxTemplate):
+    def __init__(self, plantilla_precompilada):
+        super().__init__(BytesIO(plantilla_precompilada.contenido))
+        self._plantilla_precompilada = plantilla_precompilada
+
+    def build_xml(self, context, jinja_env=None):
+        # El XML del cuerpo ya viene parcheado desde el registro
+        return self.render_xml_part(self._plantilla_precompilada.xml_cuerpo, self.docx._part, context, jinja_env)
+
+    def render(self, context, jinja_env=None, autoescape=False):
+        if jinja_env is None and not autoescape:
+            jinja_env = self._plantilla_precompilada.entorno_jinja
+        super().render(context, jinja_env, autoescape)
+
+class RegistroPlantillas:
+    def __init__(self):
+        self._plantillas = {}
+        self._lock = threading.Lock()
+
+    def obtener(self, ruta):
+        # Lanza FileNotFoundError si la plantilla no existe, igual que open(). Las rutas relativas
+        # (ej. "plantillas/2_REBA.docx") se resuelven desde la carpeta del proyecto, no desde el cwd.
+        if not os.path.isabs(ruta):
+            ruta = os.path.join(DIRECTORIO_PROYECTO, ruta)
+        info = os.stat(ruta)
+        with self._lock:
+            plantilla = self._plantillas.get(ruta)
+            if plantilla is None or plantilla.firma_archivo != (info.st_mtime_ns, info.st_size):
+                plantilla = PlantillaPrecompilada(ruta)
+                self._plantillas[ruta] = plantilla
+            return plantilla
+
+    def precargar(self, rutas):
+        for ruta in rutas:
+            try:
+                self.obtener(ruta)
+            except FileNotFoundError:
+                pass # Se informará al intentar usarla
+
+    def nueva_instancia(self, ruta):
+        return self.obtener(ruta).nueva_instancia()
+
+DIRECTORIO_PROYECTO = os.path.dirname(os.path.abspath(__file__))
+_registro_plantillas_proceso = None
+_lock_registro_plantillas = threading.Lock()
+
+def obtener_registro_plantillas():
+    # Registro único por proceso (la app web, el proceso del lote y cada proceso de trabajo tienen el suyo)
+    global _registro_plantillas_proceso
+    with _lock_registro_plantillas:
+        if _registro_plantillas_proceso is None:
+            _registro_plantillas_proceso = RegistroPlantillas()
+        return _registro_plantillas_proceso
+
+# --- Función para Generar el DOCX en memoria ---
+def generar_docx_en_memoria(plantilla, contexto_render, informar=informar_por_log, medicion=SIN_MEDICION):
+    # plantilla: instancia obtenida de RegistroPlantillas.nueva_instancia() o un archivo .docx (BytesIO/ruta)
+    try:
+        doc = plantilla if isinstance(plantilla, DocxTemplate) else DocxTemplate(plantilla)
+        with medicion.etapa("render_plantilla"):
+            doc.render(contexto_render)
+        file_stream = BytesIO()
+        with medicion.etapa("guardar_docx"):
+            doc.save(file_stream)
+        file_stream.seek(0)
+        return file_stream
+    except Exception as e:
+        informar("error", f"Error al generar el documento Word: {e}")
+        traceback.print_exc()
+        return None
+
+# --- Ubicación de los datos en las Hojas 1 y 2 ---
+# Hoja 1: celda (fila, columna) de cada campo, por sección
+MAPEO_HOJA1 = {
+    "1. ANTECEDENTES DE LA EMPRESA": {"Razón Social": (15, 'E'), "RUT Empresa": (15, 'L'), "Actividad Económica": (17, 'E'), "Código CIIU": (17, 'L'), "Dirección": (19, 'E'), "Comuna": (19, 'L'), "Nombre Representante Legal": (21, 'E'), "Organismo administrador al que está adherido": (23, 'E'), "Fecha inicio": (23, 'L')},
+    "2. CENTRO DE TRABAJO O LUGAR DE TRABAJO": {"Nombre del centro de trabajo": (27, 'E'), "Dirección": (29, 'E'), "Comuna": (29, 'L'), "Nº Trabajadores Hombres": (31, 'G'), "Nº Trabajadores Mujeres": (31, 'L')},
+    "3. RESPONSABLE IMPLEMENTACIÓN PROTOCOLO": {"Nombre responsable": (35, 'E'), "Cargo": (37, 'E'), "Correo electrónico": (39, 'E'), "Teléfono": (39, 'L')}
+}
+# Hoja 2: un encabezado por columna desde la B, a partir de FILA_INICIO_HOJA2
+FILA_INICIO_HOJA2 = 13
+FILA_FIN_MINIMA_HOJA2 = 114 # Ventana fija de la lectura original; ver _filas_puestos
+HOJA2_ENCABEZADOS = ["N°", "Área de trabajo", "Puesto de trabajo", "Tareas del puesto", "Descripción de la tarea", "Horario de funcionamiento", "HHEX dia", "HHEX sem", "N° trab exp hombre", "N° trab exp mujer", "Tipo contrato", "Tipo remuneracion", "Duración (min)", "Pausas", "Rotación", "Equipos - Herramientas", "Características ambientes - espacios trabajo", "Características disposición espacial puesto", "Características herramientas"]
+
+# --- Agentes de riesgo y ubicación de sus niveles en las hojas de factores ---
+AGENTES_RIESGO_ORDENADOS = [
+    "Repetitividad", "Postura", "MMC LDT", "MMC EA",
+    "MMP", "Vibración MB", "Vibración CC"
+]
+CONFIG_HOJAS_FACTORES = {
+    "4": {"nombre_json_agente": normalize_key(AGENTES_RIESGO_ORDENADOS[0]), "col_q_idx": 17, "col_x_idx": 24, "fila_inicio": 14, "fila_fin_minima": 116},
+    "5": {"nombre_json_agente": normalize_key(AGENTES_RIESGO_ORDENADOS[1]), "col_q_idx": 31, "col_x_idx": 49, "fila_inicio": 17, "fila_fin_minima": 116},
+    "6": {"nombre_json_agente": normalize_key(AGENTES_RIESGO_ORDENADOS[2]), "col_q_idx": 33, "col_x_idx": 56, "fila_inicio": 18, "fila_fin_minima": 118},
+    "7": {"nombre_json_agente": normalize_key(AGENTES_RIESGO_ORDENADOS[3]), "col_q_idx": 24, "col_x_idx": 41, "fila_inicio": 17, "fila_fin_minima": 117},
+    "8": {"nombre_json_agente": normalize_key(AGENTES_RIESGO_ORDENADOS[4]), "col_q_idx": 25, "col_x_idx": 41, "fila_inicio": 17, "fila_fin_minima": 117},
+    "9": {"nombre_json_agente": normalize_key(AGENTES_RIESGO_ORDENADOS[5]), "col_riesgo_directo_idx": 19, "fila_inicio": 16, "fila_fin_minima": 116}, # Vibración MB
+    "10": {"nombre_json_agente": normalize_key(AGENTES_RIESGO_ORDENADOS[6]), "col_riesgo_directo_idx": 22, "fila_inicio": 16, "fila_fin_minima": 116}  # Vibración CC
+}
+
+# --- Lectura en streaming de una ventana de celdas (libro abierto en modo read_only) ---
+def _filas_ventana(hoja, fila_inicio, fila_fin, col_inicio, col_fin):
+    # Recorre las filas [fila_inicio, fila_fin) y entrega (fila_idx, valores) con los valores de las
+    # columnas col_inicio..col_fin (ambas incluidas). Las filas vacías o más cortas se rellenan con None
+    # para que el índice de cada columna sea siempre el mismo. Con fila_fin=None se lee hasta el final.
+    ancho = col_fin - col_inicio + 1
+    filas = hoja.iter_rows(min_row=fila_inicio, max_row=fila_fin - 1 if fila_fin is not None else None, min_col=col_inicio, max_col=col_fin, values_only=True)
+    indices_filas = range(fila_inicio, fila_fin) if fila_fin is not None else itertools.count(fila_inicio)
+    for fila_idx, valores_fila in zip(indices_filas, filas):
+        valores_fila = tuple(valores_fila)
+        if len(valores_fila) < ancho:
+            valores_fila += (None,) * (ancho - len(valores_fila))
+        yield fila_idx, valores_fila
+
+# --- Filas de puestos con extensión detectada (Hoja 2 y hojas de factores) ---
+COL_NRO_PUESTO, COL_AREA_PUESTO, COL_PUESTO_PUESTO = 2, 3, 4 # Columnas B, C, D
+
+def _filas_puestos(hoja, fila_inicio, fila_fin_minima, ultima_fila_nro, col_fin, extension):
+    # Entrega (fila_idx, valores, nro_puesto) de las filas con N°, área y puesto (valores desde la columna B
+    # hasta col_fin). Se lee siempre hasta fila_fin_minima (exclusiva; la ventana fija de la lectura original)
+    # y, si la hoja sigue, hasta ultima_fila_nro: la última fila con N° según el XML de la hoja (ver
+    # ultimas_filas_con_nro_xlsx). Así las filas vaciadas en medio de la matriz no cortan la lectura y las filas
+    # solo con formato del final no se recorren. La dimensión declarada en el XML no sirve de límite porque
+    # incluye esas filas con formato; se informa igual. Sin ultima_fila_nro se lee la hoja completa.
+    # Deja en "extension" cuántas filas se leyeron y cuántas se omitieron.
+    filas_declaradas = hoja.max_row
+    hoja.reset_dimensions()
+    fila_fin = max(fila_fin_minima, ultima_fila_nro + 1) if ultima_fila_nro is not None else None
+    extension.update({"fila_inicio": fila_inicio, "ultima_fila_con_datos": None, "ultima_fila_con_nro": ultima_fila_nro, "filas_leidas": 0, "filas_con_datos": 0, "filas_omitidas": 0, "filas_declaradas": filas_declaradas})
+    for fila_idx, valores_fila in _filas_ventana(hoja, fila_inicio, fila_fin, COL_NRO_PUESTO, col_fin):
+        extension["filas_leidas"] += 1
+        nro_puesto_val = str(valores_fila[0] or "").strip()
+        val_a_obj = valores_fila[COL_AREA_PUESTO - COL_NRO_PUESTO]
+        val_p_obj = valores_fila[COL_PUESTO_PUESTO - COL_NRO_PUESTO]
+        val_a_str = str(val_a_obj).strip() if val_a_obj is not None else ""
+        val_p_str = str(val_p_obj).strip() if val_p_obj is not None else ""
+        if not (nro_puesto_val and nro_puesto_val != "0" and val_a_str and val_a_str != "0" and val_p_str and val_p_str != "0"):
+            continue
+        extension["filas_con_datos"] += 1
+        extension["ultima_fila_con_datos"] = fila_idx
+        yield fila_idx, valores_fila, nro_puesto_val
+    extension["filas_omitidas"] = extension["filas_leidas"] - extension["filas_con_datos"]
+
+# --- Función para Procesar el Excel a la Estructura JSON ---
+# Cada hoja se lee con su propia función para poder volver a leer solo algunas (ver actualizar_hojas).
+def _leer_hoja1(wb, datos_para_json, informar):
+    datos_para_json["informacion_general"] = {"antecedentes_empresa": {}, "centro_trabajo": {}, "responsable_protocolo": {}}
+    try:
+        hoja1_openpyxl = wb["1"]
+        # st.write("[INFO Hoja 1] Leyendo Hoja 1.") # Descomentar para depurar en Streamlit
+        # Se lee de una sola pasada el rectángulo que cubre todas las celdas mapeadas
+        celdas_h1 = [(fila, openpyxl.utils.column_index_from_string(col)) for campos in MAPEO_HOJA1.values() for fila, col in campos.values()]
+        fila_min_h1, fila_max_h1 = min(f for f, _ in celdas_h1), max(f for f, _ in celdas_h1)
+        col_min_h1, col_max_h1 = min(c for _, c in celdas_h1), max(c for _, c in celdas_h1)
+        valores_h1 = {}
+        for fila_idx, valores_fila in _filas_ventana(hoja1_openpyxl, fila_min_h1, fila_max_h1 + 1, col_min_h1, col_max_h1):
+            for desplazamiento, valor in enumerate(valores_fila):
+                valores_h1[(fila_idx, col_min_h1 + desplazamiento)] = valor
+        for seccion_titulo, campos in MAPEO_HOJA1.items():
+            for etiqueta, (fila_excel, col_excel_char) in campos.items():
+                valor_crudo_h1 = valores_h1.get((fila_excel, openpyxl.utils.column_index_from_string(col_excel_char)))
+                valor_str_h1 = str(valor_crudo_h1).strip() if valor_crudo_h1 is not None and str(valor_crudo_h1).strip() != "0" else ""
+                if valor_str_h1:
+                    clave_json = normalize_key(etiqueta)
+                    if seccion_titulo == "1. ANTECEDENTES DE LA EMPRESA":
+                        datos_para_json["informacion_general"]["antecedentes_empresa"][clave_json] = valor_str_h1
+                    elif seccion_titulo == "2. CENTRO DE TRABAJO O LUGAR DE TRABAJO":
+                        datos_para_json["informacion_general"]["centro_trabajo"][clave_json] = valor_str_h1
+                    elif seccion_titulo == "3. RESPONSABLE IMPLEMENTACIÓN PROTOCOLO":
+                        datos_para_json["informacion_general"]["responsable_protocolo"][clave_json] = valor_str_h1
+    except KeyError: informar("warning", "Advertencia: No se encontró la Hoja '1' en el Excel. Se omitirá esta sección.")
+    except Exception as e: informar("error", f"Error procesando Hoja '1' del Excel: {e}"); traceback.print_exc()
+
+def _leer_hoja2(wb, datos_para_json, informar, ultima_fila_nro=None):
+    # Arma puestos_trabajo_detalle con todos los agentes en "AUSENTE"
+    datos_para_json["puestos_trabajo_detalle"] = []
+    try:
+        hoja2 = wb["2"]
+        # st.write("[INFO Hoja 2] Leyendo Hoja 2.")
+        # Filas desde FILA_INICIO_HOJA2, columnas B en adelante (una por encabezado)
+        extension_h2 = datos_para_json["metadata"]["extension_hojas"]["2"] = {}
+        for fila_idx, valores_fila, nro_puesto_val in _filas_puestos(hoja2, FILA_INICIO_HOJA2, FILA_FIN_MINIMA_HOJA2, ultima_fila_nro, COL_NRO_PUESTO + len(HOJA2_ENCABEZADOS) - 1, extension_h2):
+            current_row_values = [str(valor or "") for valor in valores_fila]
+            if any(val.strip() for val in current_row_values):
+                puesto_detalle_json = {normalize_key(HOJA2_ENCABEZADOS[i]): current_row_values[i] for i in range(len(HOJA2_ENCABEZADOS)) if i < len(current_row_values)}
+                puesto_detalle_json["niveles_riesgo_agentes"] = {normalize_key(agente): "AUSENTE" for agente in AGENTES_RIESGO_ORDENADOS}
+                datos_para_json["puestos_trabajo_detalle"].append(puesto_detalle_json)
+    except KeyError: informar("warning", "Advertencia: No se encontró la Hoja '2' en el Excel. Se omitirá la caracterización de puestos.")
+    except Exception as e: informar("error", f"Error procesando Hoja '2' del Excel: {e}"); traceback.print_exc()
+
+def _leer_hoja_factor(wb, num_hoja_str, config, datos_para_json, informar, ultima_fila_nro=None):
+    # Asigna a cada puesto de la Hoja 2 su nivel para el agente de esta hoja; los que no aparecen quedan en "AUSENTE"
+    # N° de puesto (como lo entrega _filas_puestos) -> posición; con N° repetido gana el último, como en la Hoja 2
+    mapa_nro_puesto_a_indice_json = {str(puesto.get(normalize_key("N°"), "")).strip(): indice for indice, puesto in enumerate(datos_para_json["puestos_trabajo_detalle"])}
+    for puesto in datos_para_json["puestos_trabajo_detalle"]:
+        puesto["niveles_riesgo_agentes"][config["nombre_json_agente"]] = "AUSENTE"
+    try:
+        hoja_actual = wb[num_hoja_str]
+        # st.write(f"[INFO Hoja {num_hoja_str}] Leyendo Hoja {num_hoja_str} - Agente: {config['nombre_json_agente']}.")
+        col_max_factor = max(config.get("col_riesgo_directo_idx", 0), config.get("col_q_idx", 0), config.get("col_x_idx", 0))
+        valor_en = lambda valores_fila, col_idx: valores_fila[col_idx - COL_NRO_PUESTO]
+        extension_factor = datos_para_json["metadata"]["extension_hojas"][num_hoja_str] = {}
+        for fila_idx, valores_fila, nro_puesto_riesgo in _filas_puestos(hoja_actual, config["fila_inicio"], config["fila_fin_minima"], ultima_fila_nro, col_max_factor, extension_factor):
+            risk_level_text = "No Determinado"
+            if "col_riesgo_directo_idx" in config:
+                valor_crudo = valor_en(valores_fila, config["col_riesgo_directo_idx"])
+                valor_str_norm = str(valor_crudo).strip().lower() if valor_crudo is not None else ""
+                if valor_str_norm == "aceptable": risk_level_text = "ACEPTABLE"
+                elif valor_str_norm == "no aceptable": risk_level_text = "CRÍTICO"
+                elif valor_str_norm: risk_level_text = str(valor_crudo).strip().upper()
+            else:
+                valor_q_crudo = valor_en(valores_fila, config["col_q_idx"])
+                valor_q_str = str(valor_q_crudo).strip().lower() if valor_q_crudo is not None else ""
+                if valor_q_str == "no aceptable":
+                    valor_x_crudo = valor_en(valores_fila, config["col_x_idx"])
+                    valor_x_str = str(valor_x_crudo).strip().lower() if valor_x_crudo is not None else ""
+                    if "no crítico" in valor_x_str or "intermedio" in valor_x_str: risk_level_text = "INTERMEDIO"
+                    elif "crítico" in valor_x_str: risk_level_text = "CRÍTICO"
+                elif valor_q_str == "aceptable": risk_level_text = "ACEPTABLE"
+            if nro_puesto_riesgo in mapa_nro_puesto_a_indice_json:
+                indice_puesto = mapa_nro_puesto_a_indice_json[nro_puesto_riesgo]
+                datos_para_json["puestos_trabajo_detalle"][indice_puesto]["niveles_riesgo_agentes"][config["nombre_json_agente"]] = risk_level_text
+            # else:
+                # st.warning(f"Advertencia: N° de puesto '{nro_puesto_riesgo}' de Hoja {num_hoja_str} (Agente: {config['nombre_json_agente']}) no encontrado en caracterizaciones de Hoja 2.")
+    except KeyError: informar("warning", f"Advertencia: No se encontró la Hoja '{num_hoja_str}' en el Excel. Se omitirá este factor de riesgo.")
+    except Exception as e: informar("error", f"Error procesando Hoja '{num_hoja_str}' del Excel: {e}"); traceback.print_exc()
+
+def _armar_resumen(datos_para_json):
+    # Una fila por puesto (comparte el diccionario niveles_riesgo_agentes del puesto), ordenada por N°
+    resumen = []
+    for puesto_detalle in datos_para_json["puestos_trabajo_detalle"]:
+        item_resumen = {"nro": puesto_detalle.get(normalize_key("N°"), ""), "area": puesto_detalle.get(normalize_key("Área de trabajo"), ""), "puesto": puesto_detalle.get(normalize_key("Puesto de trabajo"), ""), "tarea": puesto_detalle.get(normalize_key("Tareas del puesto"), ""), "niveles_riesgo_agentes": puesto_detalle.get("niveles_riesgo_agentes", {})}
+        resumen.append(item_resumen)
+    datos_para_json["resumen_global_riesgos_tabla"] = sorted(resumen, key=lambda item: int(str(item["nro"]).split('.')[0]) if str(item["nro"]).replace('.','',1).isdigit() else float('inf'))
+
+def _leer_hojas(libro, datos_para_json, hojas, informar, medicion):
+    # Lee las hojas indicadas ("1", "2" y/o números de CONFIG_HOJAS_FACTORES) sobre datos_para_json y rehace
+    # el resumen y el índice. Si se lee la Hoja 2 se deben leer también las hojas de factores cargadas.
+    # libro: (wb, ultimas_filas) como lo entrega _abrir_libro.
+    wb, ultimas_filas = libro
+    ultima_fila_nro = lambda num_hoja: ultimas_filas.get(num_hoja, 0) if ultimas_filas is not None else None
+    if "1" in hojas:
+        with medicion.etapa("hoja_1"):
+            _leer_hoja1(wb, datos_para_json, informar)
+    if "2" in hojas:
+        with medicion.etapa("hoja_2"):
+            _leer_hoja2(wb, datos_para_json, informar, ultima_fila_nro("2"))
+    # Solo se abren las hojas pedidas; en modo read_only openpyxl lee el XML de cada hoja desde el .xlsx
+    # recién al recorrerla, así que las hojas omitidas nunca se descomprimen.
+    for num_hoja_str, config in CONFIG_HOJAS_FACTORES.items():
+        if num_hoja_str in hojas:
+            with medicion.etapa(f"hoja_{num_hoja_str}", agente=config["nombre_json_agente"]):
+                _leer_hoja_factor(wb, num_hoja_str, config, datos_para_json, informar, ultima_fila_nro(num_hoja_str))
+    with medicion.etapa("resumen"):
+        _armar_resumen(datos_para_json)
+    with medicion.etapa("indice_riesgos"):
+        datos_para_json["indice_riesgos"] = construir_indice_riesgos(datos_para_json)
+
+def _abrir_libro(archivo_excel, informar, medicion):
+    # (wb en modo read_only, {hoja: última fila con N°} o None); (None, None) si no se pudo abrir
+    with medicion.etapa("abrir_libro"):
+        ultimas_filas = ultimas_filas_con_nro_xlsx(archivo_excel)
+        try:
+            return openpyxl.load_workbook(archivo_excel, read_only=True, data_only=True), ultimas_filas
+        except Exception as e:
+            informar("error", f"Error al abrir el archivo Excel: {e}")
+            traceback.print_exc()
+            return None, None
+
+def _estructura_vacia(nombre_archivo):
+    return {
+        "metadata": {
+            "nombre_archivo_original": nombre_archivo,
+            "fecha_procesamiento": datetime.now().isoformat(),
+            "extension_hojas": {},
+            "agentes_cargados": []
+        },
+        "informacion_general": {},
+        "puestos_trabajo_detalle": [],
+        "resumen_global_riesgos_tabla": []
+    }
+
+def _hojas_de_agentes(claves_agentes):
+    return [num_hoja for num_hoja, config in CONFIG_HOJAS_FACTORES.items() if config["nombre_json_agente"] in claves_agentes]
+
+def excel_a_estructura_json(uploaded_excel_file, agentes_requeridos=None, informar=informar_por_log, medicion=SIN_MEDICION):
+    # agentes_requeridos: nombres de los agentes cuyos niveles de riesgo necesita el informe
+    # (ej. {"Postura"}). Con None se procesan todas las hojas de factores "4" a "10".
+    # medicion: MedicionEtapas que recibe el tiempo y la memoria de cada hoja leída.
+    if uploaded_excel_file is None:
+        return None
+    libro = _abrir_libro(uploaded_excel_file, informar, medicion)
+    if libro[0] is None:
+        return None
+
+    datos_para_json = _estructura_vacia(uploaded_excel_file.name if hasattr(uploaded_excel_file, 'name') else "archivo_excel_cargado.xlsx")
+    # Los agentes no cargados conservan el nivel "AUSENTE"
+    if agentes_requeridos is None:
+        claves_agentes_requeridos = {config["nombre_json_agente"] for config in CONFIG_HOJAS_FACTORES.values()}
+    else:
+        claves_agentes_requeridos = {normalize_key(agente) for agente in agentes_requeridos}
+    hojas_factores = _hojas_de_agentes(claves_agentes_requeridos)
+    datos_para_json["metadata"]["agentes_cargados"] = [CONFIG_HOJAS_FACTORES[num_hoja]["nombre_json_agente"] for num_hoja in hojas_factores]
+    _leer_hojas(libro, datos_para_json, ["1", "2"] + hojas_factores, informar, medicion)
+    libro[0].close() # En modo read_only el libro mantiene abierto el archivo subyacente
+    return datos_para_json
+
+def actualizar_hojas(datos_previos, archivo_excel, hojas, informar=informar_por_log, medicion=SIN_MEDICION, libro=None):
+    # Vuelve a leer solo "hojas" de archivo_excel sobre una copia de datos_previos (la estructura de una
+    # versión anterior de la misma matriz) y la devuelve; None si no se pudo abrir el archivo.
+    # Si "2" está entre las hojas se leen también todas las hojas de factores de agentes_cargados: los
+    # niveles se asignan por N° a los puestos de la Hoja 2. libro: el de _abrir_libro, si ya está abierto.
+    datos = copy.deepcopy(datos_previos)
+    hojas = set(hojas)
+    if "2" in hojas:
+        hojas.update(_hojas_de_agentes(datos["metadata"]["agentes_cargados"]))
+    cerrar_libro = libro is None
+    if libro is None:
+        libro = _abrir_libro(archivo_excel, informar, medicion)
+        if libro[0] is None:
+            return None
+    try:
+        _leer_hojas(libro, datos, hojas, informar, medicion)
+    finally:
+        if cerrar_libro:
+            libro[0].close()
+    datos["metadata"]["agentes_cargados"] = [config["nombre_json_agente"] for num_hoja, config in CONFIG_HOJAS_FACTORES.items() if num_hoja in hojas or config["nombre_json_agente"] in datos["metadata"]["agentes_cargados"]]
+    datos["metadata"]["fecha_procesamiento"] = datetime.now().isoformat()
+    return datos
+
+# --- Índice de niveles de riesgo y consultas sobre los puestos ---
+# El índice guarda posiciones (no copias) dentro de puestos_trabajo_detalle y resumen_global_riesgos_tabla,
+# y es JSON puro, así que viaja con los datos por la caché y hacia los procesos de trabajo:
+#   "por_agente_nivel": {clave_agente: {nivel: [posiciones de puestos]}}
+#   "por_area": {área: [posiciones de puestos]}
+#   "resumen_por_nro": {N°: [posiciones en el resumen]}
+# Las posiciones están en orden creciente. Cualquier cambio en los niveles de los puestos debe
+# terminar reconstruyendo el índice con construir_indice_riesgos().
+def construir_indice_riesgos(datos):
+    por_agente_nivel, por_area, resumen_por_nro = {}, {}, {}
+    for posicion, puesto in enumerate(datos.get("puestos_trabajo_detalle", [])):
+        for clave_agente, nivel in puesto.get("niveles_riesgo_agentes", {}).items():
+            por_agente_nivel.setdefault(clave_agente, {}).setdefault(nivel, []).append(posicion)
+        por_area.setdefault(str(puesto.get(normalize_key("Área de trabajo"), "")).strip(), []).append(posicion)
+    for posicion, resumen in enumerate(datos.get("resumen_global_riesgos_tabla", [])):
+        resumen_por_nro.setdefault(resumen.get("nro"), []).append(posicion)
+    return {"por_agente_nivel": por_agente_nivel, "por_area": por_area, "resumen_por_nro": resumen_por_nro}
+
+def obtener_indice_riesgos(datos):
+    # Datos armados antes de existir el índice (o a mano) lo construyen aquí la primera vez
+    if "indice_riesgos" not in datos:
+        datos["indice_riesgos"] = construir_indice_riesgos(datos)
+    return datos["indice_riesgos"]
+
+def consultar_puestos(datos, agentes=None, niveles=None, areas=None):
+    # Posiciones de los puestos que tienen alguno de los niveles en alguno de los agentes (O entre agentes
+    # y entre niveles) y pertenecen a alguna de las áreas (Y con lo anterior). None = sin restricción.
+    # Ej.: consultar_puestos(datos, agentes=["Postura", "MMC LDT"], niveles=["CRÍTICO"]).
+    indice = obtener_indice_riesgos(datos)
+    posiciones = None
+    if agentes is not None or niveles is not None:
+        claves_agentes = indice["por_agente_nivel"].keys() if agentes is None else [normalize_key(agente) for agente in agentes]
+        posiciones = set()
+        for clave_agente in claves_agentes:
+            niveles_agente = indice["por_agente_nivel"].get(clave_agente, {})
+            for nivel in (niveles_agente.keys() if niveles is None else niveles):
+                posiciones.update(niveles_agente.get(nivel, ()))
+    if areas is not None:
+        posiciones_area = {posicion for area in areas for posicion in indice["por_area"].get(str(area).strip(), ())}
+        posiciones = posiciones_area if posiciones is None else posiciones & posiciones_area
+    if posiciones is None:
+        return list(range(len(datos.get("puestos_trabajo_detalle", []))))
+    return sorted(posiciones)
+
+def filas_resumen_de_puestos(datos, posiciones):
+    # Filas de resumen_global_riesgos_tabla de esos puestos, en el orden del resumen
+    indice = obtener_indice_riesgos(datos)
+    puestos = datos.get("puestos_trabajo_detalle", [])
+    numeros = {puestos[posicion].get(normalize_key("N°")) for posicion in posiciones}
+    resumen = datos.get("resumen_global_riesgos_tabla", [])
+    return [resumen[posicion] for posicion in sorted(posicion for nro in numeros for posicion in indice["resumen_por_nro"].get(nro, ()))]
+
+def contar_niveles(datos, agentes=None, areas=None):
+    # {clave_agente: {nivel: cantidad de puestos}} para tableros; con areas solo cuenta los puestos de esas áreas
+    indice = obtener_indice_riesgos(datos)
+    claves_agentes = indice["por_agente_nivel"].keys() if agentes is None else [normalize_key(agente) for agente in agentes]
+    posiciones_area = None if areas is None else set(consultar_puestos(datos, areas=areas))
+    conteo = {}
+    for clave_agente in claves_agentes:
+        niveles_agente = indice["por_agente_nivel"].get(clave_agente, {})
+        conteo[clave_agente] = {nivel: len(posiciones) if posiciones_area is None else len(posiciones_area.intersection(posiciones)) for nivel, posiciones in niveles_agente.items()}
+    return conteo
+
+# --- Huellas por hoja dentro del .xlsx (para volver a leer solo las hojas modificadas) ---
+# Un .xlsx es un zip con un XML por hoja. Las celdas de texto guardan solo un índice a xl/sharedStrings.xml,
+# que Excel reescribe al guardar, por eso la huella de cada hoja es el SHA-256 de su XML más el texto de las
+# cadenas compartidas que usa. "_libro" cubre lo que afecta a todas las hojas (lista de hojas y estilos,
+# de los que depende que un número se lea como fecha): si cambia, se reprocesa todo.
+_NS_HOJA_CALCULO = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_NS_RELACIONES_DOCUMENTO = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_NS_RELACIONES_PAQUETE = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+_PATRON_CELDA_TEXTO_COMPARTIDO = re.compile(rb'<(?:\w+:)?c\b[^>]*?\bt="s"[^>]*>\s*<(?:\w+:)?v>(\d+)</(?:\w+:)?v>')
+
+def _ruta_parte(relacion):
+    return relacion.get("Target").lstrip("/") if relacion.get("Target").startswith("/") else posixpath.normpath(posixpath.join("xl", relacion.get("Target")))
+
+def _partes_xlsx(archivo_zip):
+    # (relaciones del libro por Id, [(nombre_hoja, ruta de su XML en el .xlsx), ...] en el orden del libro)
+    relaciones = {relacion.get("Id"): relacion for relacion in ET.fromstring(archivo_zip.read("xl/_rels/workbook.xml.rels")).iter(f"{_NS_RELACIONES_PAQUETE}Relationship")}
+    hojas = [(hoja.get("name"), _ruta_parte(relaciones[hoja.get(f"{_NS_RELACIONES_DOCUMENTO}id")])) for hoja in ET.fromstring(archivo_zip.read("xl/workbook.xml")).iter(f"{_NS_HOJA_CALCULO}sheet")]
+    return relaciones, hojas
+
+def huellas_hojas_xlsx(contenido_excel):
+    # {nombre_hoja: huella, "_libro": huella}; None si el archivo no es un .xlsx que se pueda leer así
+    try:
+        with zipfile.ZipFile(BytesIO(contenido_excel)) as archivo_zip:
+            relaciones, hojas = _partes_xlsx(archivo_zip)
+            ruta_parte = _ruta_parte
+            cadenas_compartidas = []
+            for relacion in relaciones.values():
+                if relacion.get("Type", "").endswith("/sharedStrings"):
+                    for item in ET.fromstring(archivo_zip.read(ruta_parte(relacion))).iter(f"{_NS_HOJA_CALCULO}si"):
+                        cadenas_compartidas.append("".join(texto.text or "" for texto in item.iter(f"{_NS_HOJA_CALCULO}t")).encode("utf-8"))
+            huella_libro = hashlib.sha256(repr(hojas).encode("utf-8"))
+            for relacion in relaciones.values():
+                if relacion.get("Type", "").endswith("/styles"):
+                    huella_libro.update(archivo_zip.read(ruta_parte(relacion)))
+            huellas = {"_libro": huella_libro.hexdigest()}
+            for nombre_hoja, ruta in hojas:
+                xml_hoja = archivo_zip.read(ruta)
+                huella = hashlib.sha256(xml_hoja)
+                for indice in _PATRON_CELDA_TEXTO_COMPARTIDO.findall(xml_hoja):
+                    indice = int(indice)
+                    huella.update(cadenas_compartidas[indice] if indice < len(cadenas_compartidas) else b"")
+                    huella.update(b"\x00")
+                huellas[nombre_hoja] = huella.hexdigest()
+            return huellas
+    except (zipfile.BadZipFile, KeyError, ET.ParseError, ValueError):
+        return None
+
+# Celdas de la columna N° (B): atributos, fila y contenido (vacío si la celda es <c .../>, solo formato)
+_PATRON_CELDA_COLUMNA_NRO = re.compile(rb'<(?:\w+:)?c\b([^>]*?)\br="B(\d+)"([^>]*?)(?:/>|>(.*?)</(?:\w+:)?c>)', re.DOTALL)
+_PATRON_VALOR_CELDA = re.compile(rb'<(?:\w+:)?[vt]\b[^>]*>([^<]*)<')
+
+def _filas_con_nro_puesto(xml_hoja):
+    # Filas cuya celda B tiene un valor distinto de 0 (un 0 en una celda de texto compartido es un índice, no el valor)
+    for atributos_antes, fila, atributos_despues, contenido in _PATRON_CELDA_COLUMNA_NRO.findall(xml_hoja):
+        valor = _PATRON_VALOR_CELDA.search(contenido or b"")
+        if valor is None or not valor.group(1).strip():
+            continue
+        if valor.group(1).strip() == b"0" and b't="s"' not in atributos_antes + atributos_despues:
+            continue
+        yield int(fila)
+
+def ultimas_filas_con_nro_xlsx(archivo_excel):
+    # {nombre_hoja: última fila con N° (0 si no hay)} de la Hoja 2 y las hojas de factores, leyendo el XML de cada
+    # hoja sin openpyxl; None si no se puede leer así (entonces cada hoja se lee completa). archivo_excel: ruta o
+    # archivo abierto (se deja en la misma posición).
+    posicion = archivo_excel.tell() if hasattr(archivo_excel, "tell") else None
+    try:
+        with zipfile.ZipFile(archivo_excel) as archivo_zip:
+            rutas_hojas = dict(_partes_xlsx(archivo_zip)[1])
+            return {num_hoja: max(_filas_con_nro_puesto(archivo_zip.read(rutas_hojas[num_hoja])), default=0) for num_hoja in ["2", *CONFIG_HOJAS_FACTORES] if num_hoja in rutas_hojas}
+    except (OSError, zipfile.BadZipFile, KeyError, ET.ParseError, ValueError):
+        return None
+    finally:
+        if posicion is not None:
+            archivo_excel.seek(posicion)
+
+def contar_puestos_xlsx(contenido_excel):
+    # Estimación rápida de los puestos de la Hoja 2 (filas desde FILA_INICIO_HOJA2 con N°) sin abrir el libro
+    # con openpyxl; None si no se puede leer así. La cola de la app la usa para estimar la memoria de un trabajo.
+    try:
+        with zipfile.ZipFile(BytesIO(contenido_excel)) as archivo_zip:
+            ruta_hoja2 = dict(_partes_xlsx(archivo_zip)[1]).get("2")
+            if ruta_hoja2 is None:
+                return None
+            return sum(1 for fila in _filas_con_nro_puesto(archivo_zip.read(ruta_hoja2)) if fila >= FILA_INICIO_HOJA2)
+    except (zipfile.BadZipFile, KeyError, ET.ParseError, ValueError):
+        return None
+
+def hojas_modificadas(huellas_nuevas, huellas_previas):
+    # Hojas del libro nuevo cuya huella difiere (o que no existían); todas si cambió "_libro"
+    if huellas_previas is None or huellas_nuevas.get("_libro") != huellas_previas.get("_libro"):
+        return [hoja for hoja in huellas_nuevas if hoja != "_libro"]
+    return [hoja for hoja, huella in huellas_nuevas.items() if hoja != "_libro" and huellas_previas.get(hoja) != huella]
+
+# --- Caché de libros procesados (clave: SHA-256 del archivo + versión del diseño de hojas) ---
+# Cambiar VERSION_LAYOUT_HOJAS cada vez que se modifique MAPEO_HOJA1, HOJA2_ENCABEZADOS,
+# CONFIG_HOJAS_FACTORES, la detección del fin de los datos o la forma de la estructura (ej. indice_riesgos),
+# para que no se reutilicen estructuras generadas con el diseño anterior.
+VERSION_LAYOUT_HOJAS = "achs-v7.5"
+
+class CacheLibrosTMERT:
+    # Nivel en memoria LRU acotado por número de entradas y nivel opcional en disco (pickle) acotado
+    # por tamaño total; al superarlo se eliminan primero los archivos usados hace más tiempo.
+    # Además recuerda la última versión de cada matriz (por nombre de archivo, huella de la Hoja 1 y RUT
+    # de la empresa) para que una nueva versión solo vuelva a leer las hojas que cambiaron. Ese registro
+    # vive solo en memoria y se separa por ámbito (en la app, la sesión): un usuario no encuentra como
+    # "versión anterior" la matriz que subió otro.
+    def __init__(self, max_entradas_memoria=16, directorio_disco=None, max_bytes_disco=256 * 1024 * 1024):
+        self.max_entradas_memoria = max_entradas_memoria
+        self.directorio_disco = directorio_disco
+        self.max_bytes_disco = max_bytes_disco
+        self._memoria = OrderedDict()
+        self._versiones = OrderedDict() # (ámbito, "archivo" | "hoja1" | "rut", valor) -> clave de la caché
+        self._lock = threading.Lock()
+        self.estadisticas = {"aciertos_memoria": 0, "aciertos_disco": 0, "fallos": 0}
+        if directorio_disco:
+            os.makedirs(directorio_disco, exist_ok=True)
+
+    def _ruta_disco(self, clave):
+        return os.path.join(self.directorio_disco, f"{clave}.pkl")
+
+    def obtener(self, clave):
+        with self._lock:
+            if clave in self._memoria:
+                self._memoria.move_to_end(clave)
+                self.estadisticas["aciertos_memoria"] += 1
+                return self._memoria[clave]
+            if self.directorio_disco:
+                ruta = self._ruta_disco(clave)
+                try:
+                    with open(ruta, "rb") as f_cache:
+                        datos = pickle.load(f_cache)
+                    os.utime(ruta) # Marca el archivo como usado recientemente para la expulsión
+                except (OSError, pickle.UnpicklingError, EOFError):
+                    datos = None
+                if datos is not None:
+                    self.estadisticas["aciertos_disco"] += 1
+                    self._guardar_en_memoria(clave, datos)
+                    return datos
+            self.estadisticas["fallos"] += 1
+            return None
+
+    def guardar(self, clave, datos):
+        with self._lock:
+            self._guardar_en_memoria(clave, datos)
+            if self.directorio_disco:
+                try:
+                    ruta_tmp = self._ruta_disco(clave) + ".tmp"
+                    with open(ruta_tmp, "wb") as f_cache:
+                        pickle.dump(datos, f_cache, protocol=pickle.HIGHEST_PROTOCOL)
+                    os.replace(ruta_tmp, self._ruta_disco(clave))
+                    self._expulsar_disco()
+                except OSError:
+                    traceback.print_exc()
+
+    def registrar_version(self, identificadores, clave, ambito=None):
+        with self._lock:
+            for tipo, valor in identificadores:
+                if valor:
+                    self._versiones[(ambito, tipo, valor)] = clave
+                    self._versiones.move_to_end((ambito, tipo, valor))
+            while len(self._versiones) > 4 * self.max_entradas_memoria:
+                self._versiones.popitem(last=False)
+
+    def buscar_version(self, identificadores, ambito=None):
+        # Clave de la versión anterior registrada en el mismo ámbito con el primero de los identificadores que coincida
+        with self._lock:
+            for tipo, valor in identificadores:
+                if valor and (ambito, tipo, valor) in self._versiones:
+                    return self._versiones[(ambito, tipo, valor)]
+        return None
+
+    def _guardar_en_memoria(self, clave, datos):
+        self._memoria[clave] = datos
+        self._memoria.move_to_end(clave)
+        while len(self._memoria) > self.max_entradas_memoria:
+            self._memoria.popitem(last=False)
+
+    def _expulsar_disco(self):
+        archivos = []
+        for nombre in os.listdir(self.directorio_disco):
+            if nombre.endswith(".pkl"):
+                ruta = os.path.join(self.directorio_disco, nombre)
+                try:
+                    info = os.stat(ruta)
+                except OSError:
+                    continue
+                archivos.append((info.st_mtime, info.st_size, ruta))
+        total_bytes = sum(tamano for _, tamano, _ in archivos)
+        for _, tamano, ruta in sorted(archivos):
+            if total_bytes <= self.max_bytes_disco:
+                break
+            try:
+                os.remove(ruta)
+                total_bytes -= tamano
+            except OSError:
+                pass
+
+def excel_a_estructura_json_cacheado(contenido_excel, nombre_archivo, cache, agentes_requeridos=None, informar=informar_por_log, medicion=SIN_MEDICION, ambito=None):
+    # Igual que excel_a_estructura_json pero a partir de los bytes del archivo y reutilizando la caché:
+    # - Mismo archivo ya procesado: se usa la entrada; si le faltan agentes, solo se leen esas hojas.
+    # - Nueva versión de una matriz ya procesada (mismo nombre de archivo, misma Hoja 1 o mismo RUT de
+    #   empresa) subida en el mismo ámbito (ej. la misma sesión de la app): solo se leen las hojas cuya huella
+    #   cambió y las de agentes que falten. Las entradas por contenido sí se comparten entre ámbitos.
+    # - Si no, se lee todo el libro.
+    # metadata["reproceso"] indica qué se hizo: {"modo": "cache" | "incremental" | "completo",
+    # "archivo_previo", "hojas_modificadas", "hojas_leidas"}. Siempre entrega una copia: procesar_y_enriquecer_datos
+    # modifica los datos.
+    with medicion.etapa("hash_archivo", bytes=len(contenido_excel)):
+        clave = f"{hashlib.sha256(contenido_excel).hexdigest()}-{VERSION_LAYOUT_HOJAS}"
+    if agentes_requeridos is None:
+        agentes_requeridos = AGENTES_RIESGO_ORDENADOS
+    claves_agentes_requeridos = {normalize_key(agente) for agente in agentes_requeridos}
+    archivo_excel = BytesIO(contenido_excel)
+    archivo_excel.name = nombre_archivo
+    reproceso = {"modo": "cache", "archivo_previo": None, "hojas_modificadas": [], "hojas_leidas": []}
+    datos_cache = cache.obtener(clave)
+    if datos_cache is not None:
+        hojas_faltantes = _hojas_de_agentes(claves_agentes_requeridos - set(datos_cache["metadata"]["agentes_cargados"]))
+        if hojas_faltantes:
+            datos_cache = actualizar_hojas(datos_cache, archivo_excel, hojas_faltantes, informar=informar, medicion=medicion)
+            if datos_cache is None:
+                return None
+            reproceso["hojas_leidas"] = hojas_faltantes
+            cache.guardar(clave, datos_cache)
+    else:
+        with medicion.etapa("huellas_hojas"):
+            huellas = huellas_hojas_xlsx(contenido_excel)
+        libro = _abrir_libro(archivo_excel, informar, medicion)
+        if libro[0] is None:
+            return None
+        try:
+            datos_nuevos = _estructura_vacia(nombre_archivo)
+            identificadores = [("archivo", nombre_archivo), ("hoja1", (huellas or {}).get("1"))]
+            clave_previa = cache.buscar_version(identificadores, ambito)
+            if clave_previa is None:
+                # Puede ser la misma empresa con la Hoja 1 editada y el archivo renombrado: se busca por RUT
+                with medicion.etapa("hoja_1"):
+                    _leer_hoja1(libro[0], datos_nuevos, informar)
+                reproceso["hojas_leidas"].append("1")
+                clave_previa = cache.buscar_version([("rut", datos_nuevos["informacion_general"]["antecedentes_empresa"].get("rut_empresa"))], ambito)
+            datos_previos = cache.obtener(clave_previa) if clave_previa is not None and huellas is not None else None
+            if datos_previos is not None and datos_previos["metadata"].get("huellas_hojas") is not None:
+                modificadas = hojas_modificadas(huellas, datos_previos["metadata"]["huellas_hojas"])
+                hojas_cargadas = _hojas_de_agentes(datos_previos["metadata"]["agentes_cargados"])
+                hojas_a_leer = {hoja for hoja in ["1", "2"] + hojas_cargadas if hoja in modificadas}
+                hojas_a_leer.update(_hojas_de_agentes(claves_agentes_requeridos - set(datos_previos["metadata"]["agentes_cargados"])))
+                if "2" in hojas_a_leer: # Los niveles se asignan por N° a los puestos de la Hoja 2
+                    hojas_a_leer.update(hojas_cargadas)
+                datos_cache = actualizar_hojas(datos_previos, archivo_excel, hojas_a_leer, informar=informar, medicion=medicion, libro=libro)
+                reproceso.update({"modo": "incremental", "archivo_previo": datos_previos["metadata"]["nombre_archivo_original"], "hojas_modificadas": modificadas})
+                reproceso["hojas_leidas"] = sorted(hojas_a_leer.union(reproceso["hojas_leidas"]), key=int)
+            else:
+                hojas_factores = _hojas_de_agentes(claves_agentes_requeridos)
+                datos_nuevos["metadata"]["agentes_cargados"] = [CONFIG_HOJAS_FACTORES[num_hoja]["nombre_json_agente"] for num_hoja in hojas_factores]
+                hojas_a_leer = [hoja for hoja in ["1", "2"] + hojas_factores if hoja not in reproceso["hojas_leidas"]]
+                _leer_hojas(libro, datos_nuevos, hojas_a_leer, informar, medicion)
+                datos_cache = datos_nuevos
+                reproceso.update({"modo": "completo", "hojas_leidas": ["1", "2"] + hojas_factores})
+        finally:
+            libro[0].close()
+        datos_cache["metadata"]["nombre_archivo_original"] = nombre_archivo
+        datos_cache["metadata"]["huellas_hojas"] = huellas
+        cache.guardar(clave, datos_cache)
+    cache.registrar_version([("archivo", nombre_archivo), ("hoja1", (datos_cache["metadata"].get("huellas_hojas") or {}).get("1")), ("rut", datos_cache["informacion_general"].get("antecedentes_empresa", {}).get("rut_empresa"))], clave, ambito)
+    with medicion.etapa("copia_desde_cache"):
+        datos = copy.deepcopy(datos_cache)
+    datos["metadata"]["nombre_archivo_original"] = nombre_archivo
+    datos["metadata"]["fecha_procesamiento"] = datetime.now().isoformat()
+    datos["metadata"]["reproceso"] = reproceso
+    return datos
+
+# --- Plantilla de informe asociada a cada agente de riesgo ---
+MAPEO_AGENTE_A_PLANTILLA = {
+    normalize_key("Repetitividad"): "plantillas/1_ART.docx",     # CONFIRMA ESTE NOMBRE DE ARCHIVO
+    normalize_key("Postura"): "plantillas/2_REBA.docx",           # CONFIRMA ESTE NOMBRE DE ARCHIVO
+    normalize_key("MMC LDT"): "plantillas/3_MAC.docx",
+    normalize_key("MMC EA"): "plantillas/4_RAPP.docx",
+    # normalize_key("MMP"): "plantillas/plantilla_mmp.docx",       # DESCOMENTA Y AJUSTA CUANDO TENGAS ESTA PLANTILLA
+    # normalize_key("Vibración MB"): "plantillas/plantilla_vibracion_mb.docx",
+    # normalize_key("Vibración CC"): "plantillas/plantilla_vibracion_cc.docx"
+}
+NOMBRE_AGENTE_POR_CLAVE = {normalize_key(agente): agente for agente in AGENTES_RIESGO_ORDENADOS}
+
+# --- Contexto de render filtrado por agente (puestos con nivel INTERMEDIO) ---
+def construir_contexto_informe(datos_enriquecidos, agente, datos_manuales, niveles=("INTERMEDIO",)):
+    # datos_manuales: campos ingresados por el ergónomo (numero_informe_tecnico, nombre_ergonomo, ...)
+    # Los puestos y filas de resumen salen del índice de riesgos; se pasan los mismos diccionarios, sin copiarlos.
+    puestos_originales = datos_enriquecidos.get('puestos_trabajo_detalle', [])
+    posiciones_filtradas = consultar_puestos(datos_enriquecidos, agentes=[agente], niveles=niveles)
+    puestos_filtrados = [puestos_originales[posicion] for posicion in posiciones_filtradas]
+    resumen_filtrado = filas_resumen_de_puestos(datos_enriquecidos, posiciones_filtradas)
+    contexto = {
+        'metadata': datos_enriquecidos.get('metadata', {}),
+        'informacion_general': datos_enriquecidos.get('informacion_general', {}),
+        'puestos_trabajo_detalle': puestos_filtrados,
+        'resumen_global_riesgos_tabla': resumen_filtrado,
+        'fecha_actual_reporte': datetime.now().strftime("%d-%m-%Y"), # Cambiado formato de fecha
+    }
+    contexto.update(datos_manuales)
+    return contexto
+
+def nombre_archivo_informe(nombre_excel, numero_informe, agente, extension="docx"):
+    base_name_excel = os.path.splitext(nombre_excel)[0]
+    num_informe_para_nombre = numero_informe.strip()
+    if num_informe_para_nombre:
+        prefijo_nombre = f"IT_TMERT_{num_informe_para_nombre.replace('/', '_').replace(' ', '_')}"
+    else:
+        nombre_excel_limpio = base_name_excel.replace(' ', '_')
+        prefijo_nombre = f"IT_TMERT_{nombre_excel_limpio}"
+    return f"borrador_{prefijo_nombre}_{agente.replace(' ','_')}.{extension}"
+
+# --- Informes de varios agentes y paquete ZIP ---
+def generar_informes_por_agente(datos_enriquecidos, datos_manuales, nombre_excel, agentes=None, executor=None):
+    # Renderiza un informe por cada agente con plantilla en MAPEO_AGENTE_A_PLANTILLA (o solo los de
+    # "agentes"). Con un executor de procesos los renders corren en paralelo (con hilos
+    # no: docxtpl retiene el GIL, ver obtener_pool_render); sin executor, en secuencia.
+    # Devuelve [(agente, nombre_archivo, n_puestos, bytes_docx_o_None, error_o_None), ...].
+    numero_informe = datos_manuales.get('numero_informe_tecnico', '')
+    claves_agentes = MAPEO_AGENTE_A_PLANTILLA.keys() if agentes is None else [normalize_key(agente) for agente in agentes]
+    trabajos = []
+    for clave_agente in claves_agentes:
+        agente = NOMBRE_AGENTE_POR_CLAVE.get(clave_agente, clave_agente)
+        nombre_archivo = nombre_archivo_informe(nombre_excel, numero_informe, agente)
+        ruta_plantilla = MAPEO_AGENTE_A_PLANTILLA.get(clave_agente)
+        if not ruta_plantilla:
+            trabajos.append((agente, nombre_archivo, 0, None, f"No hay plantilla mapeada para el agente '{agente}'"))
+            continue
+        contexto = construir_contexto_informe(datos_enriquecidos, agente, datos_manuales)
+        n_puestos = len(contexto['puestos_trabajo_detalle'])
+        if executor is None:
+            try:
+                trabajos.append((agente, nombre_archivo, n_puestos, _renderizar_informe(ruta_plantilla, contexto), None))
+            except Exception as e:
+                traceback.print_exc()
+                trabajos.append((agente, nombre_archivo, n_puestos, None, str(e)))
+        else:
+            trabajos.append((agente, nombre_archivo, n_puestos, executor.submit(_renderizar_informe, ruta_plantilla, contexto), None))
+    resultados = []
+    for agente, nombre_archivo, n_puestos, informe, error in trabajos:
+        if hasattr(informe, "result"):
+            try:
+                informe = informe.result()
+            except BrokenProcessPool:
+                raise
+            except Exception as e:
+                traceback.print_exc()
+                informe, error = None, str(e)
+        resultados.append((agente, nombre_archivo, n_puestos, informe, error))
+    return resultados
+
+def convertir_informes_a_pdf(informes, convertidor_pdf, executor=None):
+    # informes: salida de generar_informes_por_agente. convertidor_pdf: objeto con convertir(bytes_docx) -> bytes_pdf
+    # (ej. pdf_informesTMERT.obtener_pool_pdf(), que limita por sí mismo las conversiones simultáneas).
+    # Devuelve [(nombre_archivo_pdf, bytes_pdf_o_None, error_o_None), ...] en el mismo orden que informes.
+    trabajos = []
+    for agente, nombre_archivo, n_puestos, informe_bytes, error in informes:
+        nombre_pdf = os.path.splitext(nombre_archivo)[0] + ".pdf"
+        if informe_bytes is None:
+            trabajos.append((nombre_pdf, None, "No se generó el informe Word"))
+        elif executor is None:
+            try:
+                trabajos.append((nombre_pdf, convertidor_pdf.convertir(informe_bytes), None))
+            except Exception as e:
+                trabajos.append((nombre_pdf, None, str(e)))
+        else:
+            trabajos.append((nombre_pdf, executor.submit(convertidor_pdf.convertir, informe_bytes), None))
+    resultados = []
+    for nombre_pdf, pdf, error in trabajos:
+        if hasattr(pdf, "result"):
+            try:
+                pdf = pdf.result()
+            except Exception as e:
+                pdf, error = None, str(e)
+        resultados.append((nombre_pdf, pdf, error))
+    return resultados
+
+def generar_paquete_informes_zip(datos_enriquecidos, datos_manuales, nombre_excel, executor=None, convertidor_pdf=None):
+    # Empaqueta en un ZIP en memoria los informes de todos los agentes con plantilla. Sin executor se usa
+    # el pool de procesos ya creado (pool_render_actual(); si no hay, se renderiza en secuencia). Con convertidor_pdf
+    # se agrega también el PDF de cada informe.
+    # Devuelve (zip_bytes_io, resultados) con resultados = [(agente, n_puestos, error_o_None, error_pdf_o_None), ...].
+    if executor is None:
+        executor = pool_render_actual()
+    try:
+        informes = generar_informes_por_agente(datos_enriquecidos, datos_manuales, nombre_excel, executor=executor)
+    except BrokenProcessPool:
+        # Un proceso de render murió (ej. sin memoria): se descarta el pool (la app lo rehace en el próximo
+        # rerun) y el paquete se renderiza aquí
+        logger.warning("El pool de render quedó inutilizable; los informes se renderizan en secuencia.")
+        _descartar_pool_render(executor)
+        informes = generar_informes_por_agente(datos_enriquecidos, datos_manuales, nombre_excel)
+    if convertidor_pdf is not None:
+        # La conversión espera a soffice sin retener el GIL, así que aquí sí bastan hilos
+        with ThreadPoolExecutor(max_workers=len(informes) or 1) as executor_pdf:
+            pdfs = convertir_informes_a_pdf(informes, convertidor_pdf, executor=executor_pdf)
+    else:
+        pdfs = [(None, None, None)] * len(informes)
+    zip_stream = BytesIO()
+    with zipfile.ZipFile(zip_stream, "w", compression=zipfile.ZIP_DEFLATED) as archivo_zip:
+        for (agente, nombre_archivo, n_puestos, informe_bytes, error), (nombre_pdf, pdf_bytes, _) in zip(informes, pdfs):
+            if informe_bytes is not None:
+                archivo_zip.writestr(nombre_archivo, informe_bytes)
+            if pdf_bytes is not None:
+                archivo_zip.writestr(nombre_pdf, pdf_bytes)
+    zip_stream.seek(0)
+    return zip_stream, [(agente, n_puestos, error, error_pdf if error is None else None) for (agente, _, n_puestos, _, error), (_, _, error_pdf) in zip(informes, pdfs)]
+
+def _renderizar_informe(ruta_plantilla, contexto):
+    # Se ejecuta en hilos o procesos de trabajo: usa el registro del proceso, propaga el error y
+    # devuelve bytes (se pueden enviar de vuelta desde otro proceso).
+    doc = obtener_registro_plantillas().nueva_instancia(ruta_plantilla)
+    doc.render(contexto)
+    file_stream = BytesIO()
+    doc.save(file_stream)
+    return file_stream.getvalue()
+
+# --- Pool de procesos de render ---
+# docxtpl retiene el GIL durante todo el render, así que varios informes en hilos tardan lo mismo que en
+# secuencia: el paquete ZIP los renderiza en procesos. Se usa el método "fork" porque con spawn/forkserver
+# cada hijo vuelve a importar el __main__ del padre, que en la app es el script de Streamlit. Con fork,
+# ProcessPoolExecutor crea todos los procesos dentro del primer submit() y los hijos heredan el registro
+# con las plantillas ya compiladas. Solo obtener_pool_render() crea el pool (la app lo llama en cada rerun,
+# así también lo rehace si se rompió); los trabajos usan pool_render_actual(), que nunca hace fork desde
+# un hilo de la cola en medio de otros trabajos.
+# TMERT_RENDER_PROCESOS=<n> fija el número de procesos (por defecto, uno por plantilla sin pasar de los CPU);
+# con 0 o 1, o sin fork (Windows), no hay pool y se renderiza en secuencia.
+_pool_render_proceso = None
+_lock_pool_render = threading.Lock()
+
+def _reiniciar_locks_en_hijo():
+    # fork copia los locks tal como estaban: si otro hilo de la app tenía tomado el del registro en ese
+    # momento, el hijo quedaría bloqueado en su primer render
+    global _lock_registro_plantillas
+    _lock_registro_plantillas = threading.Lock()
+    if _registro_plantillas_proceso is not None:
+        _registro_plantillas_proceso._lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reiniciar_locks_en_hijo)
+
+def obtener_pool_render():
+    global _pool_render_proceso
+    with _lock_pool_render:
+        if _pool_render_proceso is None:
+            procesos = int(os.environ.get("TMERT_RENDER_PROCESOS", min(len(MAPEO_AGENTE_A_PLANTILLA), os.cpu_count() or 1)))
+            if procesos <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+                return None
+            obtener_registro_plantillas().precargar(MAPEO_AGENTE_A_PLANTILLA.values())
+            _pool_render_proceso = ProcessPoolExecutor(max_workers=procesos, mp_context=multiprocessing.get_context("fork"))
+            _pool_render_proceso.submit(os.getpid) # Hace los fork ahora; no se espera el resultado
+        return _pool_render_proceso
+
+def pool_render_actual():
+    # El pool ya creado, o None (ej. en el lote, o si se descartó y la app aún no lo rehízo)
+    with _lock_pool_render:
+        return _pool_render_proceso
+
+def _descartar_pool_render(pool):
+    global _pool_render_proceso
+    # Solo el pool propio: un executor recibido por parámetro lo cierra quien lo creó
+    with _lock_pool_render:
+        if _pool_render_proceso is not pool:
+            return
+        _pool_render_proceso = None
+    pool.shutdown(wait=False, cancel_futures=True)
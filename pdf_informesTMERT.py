@@ -0,0 +1,299 @@
+# Conversión DOCX -> PDF con procesos LibreOffice (soffice --headless) que quedan abiertos y se reutilizan.
+# Cada trabajador es un soffice escuchando en un socket UNO local, con su propio perfil de usuario; arrancarlo
+# cuesta varios segundos, convertir un informe con él ya abierto, una fracción de eso.
+# Requiere LibreOffice y su módulo de Python "uno" (en Debian/Ubuntu: paquetes libreoffice-writer y python3-uno).
+# Configuración por variables de entorno:
+#   TMERT_SOFFICE=<ruta a soffice>       (por defecto se busca soffice/libreoffice en el PATH)
+#   TMERT_PDF_PROCESOS=2                 conversiones simultáneas (un soffice por cada una)
+#   TMERT_PDF_TIMEOUT=120                segundos máximos por informe; al vencer se mata ese soffice
+#   TMERT_PDF_MAX_TRABAJOS=50            informes por soffice antes de reemplazarlo por uno nuevo
+import logging
+import os
+import pathlib
+import queue
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from multiprocessing.util import Finalize
+
+logger = logging.getLogger("informesTMERT.pdf")
+
+class ErrorConversionPDF(RuntimeError):
+    pass
+
+class TimeoutConversionPDF(ErrorConversionPDF):
+    pass
+
+def buscar_soffice():
+    ruta = os.environ.get("TMERT_SOFFICE")
+    if ruta:
+        return ruta if os.path.exists(ruta) else None
+    return shutil.which("soffice") or shutil.which("libreoffice")
+
+def _importar_uno():
+    try:
+        import uno
+    except ImportError as e:
+        raise ErrorConversionPDF("Falta el módulo 'uno' de LibreOffice para Python (paquete python3-uno); no se pueden generar PDF.") from e
+    return uno
+
+def pdf_disponible():
+    # True si hay soffice y el módulo uno: la app y el lote lo usan para ofrecer (o rechazar) la salida PDF
+    try:
+        _importar_uno()
+    except ErrorConversionPDF:
+        return False
+    return buscar_soffice() is not None
+
+def _puerto_libre():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class _TrabajadorLibreOffice:
+    # Un soffice headless y su conexión UNO. No es seguro para hilos: el pool entrega cada trabajador a un solo hilo.
+    def __init__(self, ruta_soffice, timeout_arranque_s):
+        self._uno = _importar_uno()
+        self.trabajos = 0
+        self.directorio = tempfile.mkdtemp(prefix="tmert_soffice_")
+        self.puerto = _puerto_libre()
+        perfil = pathlib.Path(self.directorio, "perfil").as_uri() # Dos soffice no pueden compartir perfil
+        # start_new_session: soffice lanza soffice.bin como hijo; al terminar se mata el grupo completo
+        self.proceso = subprocess.Popen(
+            [ruta_soffice, "--headless", "--invisible", "--nologo", "--nodefault", "--norestore", "--nolockcheck", "--nofirststartwizard",
+             f"-env:UserInstallation={perfil}", f"--accept=socket,host=127.0.0.1,port={self.puerto};urp;StarOffice.ComponentContext"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True
+        )
+        try:
+            self.escritorio = self._conectar(timeout_arranque_s)
+        except Exception:
+            self.cerrar()
+            raise
+
+    def _conectar(self, timeout_arranque_s):
+        contexto_local = self._uno.getComponentContext()
+        resolvedor = contexto_local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", contexto_local)
+        limite = time.monotonic() + timeout_arranque_s
+        while True:
+            if self.proceso.poll() is not None:
+                raise ErrorConversionPDF(f"LibreOffice terminó al iniciar (código {self.proceso.returncode}).")
+            try:
+                contexto = resolvedor.resolve(f"uno:socket,host=127.0.0.1,port={self.puerto};urp;StarOffice.ComponentContext")
+                return contexto.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", contexto)
+            except Exception: # NoConnectException mientras soffice todavía no abre el socket
+                if time.monotonic() > limite:
+                    raise ErrorConversionPDF(f"LibreOffice no aceptó conexiones en {timeout_arranque_s} s.")
+                time.sleep(0.25)
+
+    def _propiedades(self, **valores):
+        propiedades = []
+        for nombre, valor in valores.items():
+            propiedad = self._uno.createUnoStruct("com.sun.star.beans.PropertyValue")
+            propiedad.Name, propiedad.Value = nombre, valor
+            propiedades.append(propiedad)
+        return tuple(propiedades)
+
+    def vivo(self):
+        return self.proceso.poll() is None
+
+    def convertir(self, docx_bytes, timeout_s):
+        ruta_docx = os.path.join(self.directorio, "informe.docx")
+        ruta_pdf = os.path.join(self.directorio, "informe.pdf")
+        try:
+            with open(ruta_docx, "wb") as f_docx:
+                f_docx.write(docx_bytes)
+        except OSError as e: # Ej. disco lleno, o un limpiador de /tmp borró la carpeta de este soffice
+            raise ErrorConversionPDF(f"No se pudo escribir el informe DOCX temporal: {e}") from e
+        # Las llamadas UNO bloquean sin límite: si vencen, se mata soffice y la llamada falla con DisposedException
+        vencido = threading.Event()
+        def vencer():
+            vencido.set()
+            self.terminar()
+        temporizador = threading.Timer(timeout_s, vencer)
+        temporizador.daemon = True
+        temporizador.start()
+        try:
+            documento = self.escritorio.loadComponentFromURL(pathlib.Path(ruta_docx).as_uri(), "_blank", 0, self._propiedades(Hidden=True, ReadOnly=True))
+            if documento is None:
+                raise ErrorConversionPDF("LibreOffice no pudo abrir el informe DOCX.")
+            try:
+                documento.storeToURL(pathlib.Path(ruta_pdf).as_uri(), self._propiedades(FilterName="writer_pdf_Export"))
+            finally:
+                documento.close(True)
+            with open(ruta_pdf, "rb") as f_pdf:
+                pdf_bytes = f_pdf.read()
+        except ErrorConversionPDF:
+            raise
+        except Exception as e:
+            if vencido.is_set():
+                raise TimeoutConversionPDF(f"La conversión a PDF superó el límite de {timeout_s} s.") from e
+            try:
+                self.proceso.wait(timeout=1) # El puente UNO se cae un instante antes de que soffice termine de morir
+            except subprocess.TimeoutExpired:
+                pass
+            raise ErrorConversionPDF(f"LibreOffice no pudo convertir el informe: {e}") from e
+        finally:
+            temporizador.cancel()
+            for ruta in (ruta_docx, ruta_pdf):
+                try:
+                    os.remove(ruta)
+                except OSError: # No existe o la carpeta ya no está; no debe tapar el resultado
+                    pass
+        self.trabajos += 1
+        return pdf_bytes
+
+    def terminar(self):
+        if self.proceso.poll() is None:
+            try:
+                os.killpg(self.proceso.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self.proceso.wait()
+
+    def cerrar(self):
+        if self.vivo() and getattr(self, "escritorio", None) is not None:
+            try:
+                self.escritorio.terminate() # Cierre ordenado; si no responde, se mata igual
+            except Exception:
+                pass
+            try:
+                self.proceso.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                pass
+        self.terminar()
+        shutil.rmtree(self.directorio, ignore_errors=True)
+
+class PoolConversionPDF:
+    # Como máximo `procesos` conversiones (y soffice) a la vez; el resto de los hilos espera su turno.
+    # Los soffice se inician al primer uso (o con precalentar()) y se reemplazan tras max_trabajos_por_proceso
+    # informes, un timeout o una caída.
+    def __init__(self, procesos=2, max_trabajos_por_proceso=50, timeout_s=120, timeout_arranque_s=60, ruta_soffice=None):
+        self.procesos = procesos
+        self.max_trabajos_por_proceso = max_trabajos_por_proceso
+        self.timeout_s = timeout_s
+        self.timeout_arranque_s = timeout_arranque_s
+        self.ruta_soffice = ruta_soffice or buscar_soffice()
+        self.estadisticas = {"conversiones": 0, "arranques": 0, "reciclados": 0, "fallos": 0}
+        self._cupos = threading.BoundedSemaphore(procesos)
+        self._libres = queue.LifoQueue() # El más recientemente usado primero: los demás pueden quedar sin arrancar
+        self._trabajadores = set()
+        self._arrancando = 0 # soffice con cupo reservado que todavía están iniciando
+        self._lock = threading.Lock()
+        self._cerrado = False
+        # Finalize (y no atexit) para que también se cierren en los procesos de trabajo del lote
+        Finalize(self, self.cerrar, exitpriority=10)
+
+    def _reservar_arranque(self):
+        # Reserva (bajo el lock) el cupo de un soffice nuevo; False si ya hay `procesos` vivos o iniciando
+        with self._lock:
+            if len(self._trabajadores) + self._arrancando >= self.procesos:
+                return False
+            self._arrancando += 1
+            return True
+
+    def _nuevo_trabajador(self):
+        # Se llama con un cupo ya reservado por _reservar_arranque(); lo consume o lo libera
+        try:
+            if self.ruta_soffice is None:
+                raise ErrorConversionPDF("No se encontró LibreOffice (soffice). Instálelo o defina TMERT_SOFFICE.")
+            trabajador = _TrabajadorLibreOffice(self.ruta_soffice, self.timeout_arranque_s)
+        except BaseException:
+            with self._lock:
+                self._arrancando -= 1
+            raise
+        with self._lock:
+            self._arrancando -= 1
+            if not self._cerrado:
+                self._trabajadores.add(trabajador)
+                self.estadisticas["arranques"] += 1
+                return trabajador
+        trabajador.cerrar()
+        raise ErrorConversionPDF("El pool de conversión PDF está cerrado.")
+
+    def _descartar(self, trabajador):
+        with self._lock:
+            self._trabajadores.discard(trabajador)
+        trabajador.cerrar()
+
+    def _tomar_trabajador(self):
+        # Un soffice libre, o uno nuevo si queda cupo. Si están todos ocupados o iniciando (ej. precalentar() en
+        # otro hilo), espera a que se libere uno; revisa cada 0,5 s por si el que iniciaba falló o se descartó.
+        while True:
+            try:
+                trabajador = self._libres.get_nowait()
+            except queue.Empty:
+                if self._reservar_arranque():
+                    return self._nuevo_trabajador()
+                try:
+                    trabajador = self._libres.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+            if trabajador.vivo():
+                return trabajador
+            self._descartar(trabajador) # Murió mientras estaba libre
+
+    def precalentar(self):
+        # Deja los `procesos` soffice arrancados para que el primer informe no pague el inicio
+        while self._reservar_arranque():
+            self._libres.put(self._nuevo_trabajador())
+
+    def convertir(self, docx_bytes):
+        # docx_bytes -> pdf_bytes; lanza ErrorConversionPDF. Se puede llamar desde varios hilos.
+        if hasattr(docx_bytes, "getvalue"):
+            docx_bytes = docx_bytes.getvalue()
+        with self._cupos:
+            for intento in range(2):
+                trabajador = self._tomar_trabajador()
+                try:
+                    pdf_bytes = trabajador.convertir(docx_bytes, self.timeout_s)
+                except ErrorConversionPDF as e:
+                    caido = not trabajador.vivo() and not isinstance(e, TimeoutConversionPDF)
+                    self._descartar(trabajador)
+                    with self._lock:
+                        self.estadisticas["fallos"] += 1
+                    # Un soffice que se cayó solo (no por timeout) se reintenta una vez con uno nuevo
+                    if intento == 0 and caido:
+                        logger.warning("LibreOffice se cayó durante una conversión; se reintenta con un proceso nuevo.")
+                        continue
+                    raise
+                except BaseException:
+                    # Cualquier otro error: el soffice no vuelve a _libres sin pasar por aquí, o su cupo se perdería
+                    self._descartar(trabajador)
+                    with self._lock:
+                        self.estadisticas["fallos"] += 1
+                    raise
+                with self._lock:
+                    self.estadisticas["conversiones"] += 1
+                if trabajador.trabajos >= self.max_trabajos_por_proceso:
+                    with self._lock:
+                        self.estadisticas["reciclados"] += 1
+                    self._descartar(trabajador)
+                else:
+                    self._libres.put(trabajador)
+                return pdf_bytes
+
+    def cerrar(self):
+        with self._lock:
+            self._cerrado = True
+            trabajadores, self._trabajadores = list(self._trabajadores), set()
+        for trabajador in trabajadores:
+            trabajador.cerrar()
+
+_pool_pdf_proceso = None
+_lock_pool_pdf = threading.Lock()
+
+def obtener_pool_pdf(procesos=None):
+    # Pool único por proceso, como obtener_registro_plantillas(); `procesos` solo cuenta en la primera llamada
+    global _pool_pdf_proceso
+    with _lock_pool_pdf:
+        if _pool_pdf_proceso is None:
+            _pool_pdf_proceso = PoolConversionPDF(
+                procesos=procesos or int(os.environ.get("TMERT_PDF_PROCESOS", "2")),
+                max_trabajos_por_proceso=int(os.environ.get("TMERT_PDF_MAX_TRABAJOS", "50")),
+                timeout_s=float(os.environ.get("TMERT_PDF_TIMEOUT", "120"))
+            )
+        return _pool_pdf_proceso
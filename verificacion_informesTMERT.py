@@ -0,0 +1,250 @@
+# Verificaciones del motor de informes TMERT sobre matrices sintéticas (generador_matricesTMERT), sin Streamlit
+# ni LibreOffice. Termina con código 1 si alguna falla.
+# Uso:
+#   python verificacion_informesTMERT.py
+#   python verificacion_informesTMERT.py --puestos 10 90 300
+# Qué se verifica:
+# - lectura_original: excel_a_estructura_json (streaming, extensión detectada) frente a la lectura original de la
+#   app (libro completo, celda por celda, ventanas fijas de filas). Si la matriz cabe en esas ventanas el
+#   resultado debe ser igual; si no, cada puesto que leía la original debe leerse igual.
+# - niveles_generados: los niveles leídos son los que escribió el generador (todos los puestos, cualquier tamaño).
+# - filas_vaciadas: puestos borrados dejando sus filas vacías en medio de las hojas 2 y 5 (dentro y más allá de
+#   las ventanas originales) no cortan la lectura de los que siguen, y contar_puestos_xlsx cuenta lo mismo.
+# - incremental: excel_a_estructura_json_cacheado con una nueva versión de la matriz (hojas 1, 2 o de
+#   factores editadas, archivo renombrado) entrega lo mismo que leer la nueva versión completa.
+# - cache: acierto en memoria, agentes faltantes, acierto en disco, archivo de caché dañado y expulsión por tamaño.
+import argparse
+import copy
+import io
+import os
+import sys
+import tempfile
+import traceback
+
+import openpyxl
+
+from motor_informesTMERT import (
+    excel_a_estructura_json, excel_a_estructura_json_cacheado, CacheLibrosTMERT, MAPEO_HOJA1, HOJA2_ENCABEZADOS,
+    CONFIG_HOJAS_FACTORES, AGENTES_RIESGO_ORDENADOS, COL_NRO_PUESTO, FILA_INICIO_HOJA2, contar_puestos_xlsx, normalize_key
+)
+from generador_matricesTMERT import generar_matriz
+
+PUESTOS_POR_DEFECTO = [10, 90, 300]
+# Ventanas de filas [inicio, fin) de la lectura original: la Hoja 2 y cada hoja de factores
+VENTANAS_ORIGINALES = {"2": (13, 114), "4": (14, 116), "5": (17, 116), "6": (18, 118), "7": (17, 117), "8": (17, 117), "9": (16, 116), "10": (16, 116)}
+# (puestos, N° de los puestos vaciados en las hojas 2 y 5)
+CASOS_FILAS_VACIADAS = [(101, range(36, 66)), (300, range(150, 190))]
+# Claves de metadata que dependen de cuándo o cómo se leyó, no del contenido
+METADATA_VARIABLE = ("fecha_procesamiento", "reproceso", "huellas_hojas", "nombre_archivo_original")
+
+def _lectura_original(ruta_excel):
+    # La lectura de la app antes del motor: libro completo en memoria y ventanas fijas (ver VENTANAS_ORIGINALES)
+    wb = openpyxl.load_workbook(ruta_excel, data_only=True)
+    datos = {"informacion_general": {"antecedentes_empresa": {}, "centro_trabajo": {}, "responsable_protocolo": {}}, "puestos_trabajo_detalle": [], "resumen_global_riesgos_tabla": []}
+    secciones = dict(zip(MAPEO_HOJA1, ["antecedentes_empresa", "centro_trabajo", "responsable_protocolo"]))
+    for seccion_titulo, campos in MAPEO_HOJA1.items():
+        for etiqueta, (fila_excel, col_excel_char) in campos.items():
+            valor_crudo = wb["1"][f"{col_excel_char}{fila_excel}"].value
+            valor_str = str(valor_crudo).strip() if valor_crudo is not None and str(valor_crudo).strip() != "0" else ""
+            if valor_str:
+                datos["informacion_general"][secciones[seccion_titulo]][normalize_key(etiqueta)] = valor_str
+    def fila_valida(hoja, fila_idx):
+        nro, area, puesto = (str(hoja.cell(row=fila_idx, column=COL_NRO_PUESTO + i).value or "").strip() for i in range(3))
+        return nro if nro and nro != "0" and area and area != "0" and puesto and puesto != "0" else None
+    mapa_nro_a_indice = {}
+    for fila_idx in range(*VENTANAS_ORIGINALES["2"]):
+        nro = fila_valida(wb["2"], fila_idx)
+        if nro is None:
+            continue
+        valores = [str(wb["2"].cell(row=fila_idx, column=COL_NRO_PUESTO + i).value or "") for i in range(len(HOJA2_ENCABEZADOS))]
+        puesto = {normalize_key(encabezado): valores[i] for i, encabezado in enumerate(HOJA2_ENCABEZADOS)}
+        puesto["niveles_riesgo_agentes"] = {normalize_key(agente): "AUSENTE" for agente in AGENTES_RIESGO_ORDENADOS}
+        datos["puestos_trabajo_detalle"].append(puesto)
+        mapa_nro_a_indice[nro] = len(datos["puestos_trabajo_detalle"]) - 1
+    for num_hoja, config in CONFIG_HOJAS_FACTORES.items():
+        hoja = wb[num_hoja]
+        for fila_idx in range(*VENTANAS_ORIGINALES[num_hoja]):
+            nro = fila_valida(hoja, fila_idx)
+            if nro is None:
+                continue
+            nivel = "No Determinado"
+            if "col_riesgo_directo_idx" in config:
+                valor = str(hoja.cell(row=fila_idx, column=config["col_riesgo_directo_idx"]).value or "").strip()
+                nivel = {"aceptable": "ACEPTABLE", "no aceptable": "CRÍTICO"}.get(valor.lower(), valor.upper() or nivel)
+            else:
+                valor_q = str(hoja.cell(row=fila_idx, column=config["col_q_idx"]).value or "").strip().lower()
+                valor_x = str(hoja.cell(row=fila_idx, column=config["col_x_idx"]).value or "").strip().lower()
+                if valor_q == "no aceptable":
+                    if "no crítico" in valor_x or "intermedio" in valor_x: nivel = "INTERMEDIO"
+                    elif "crítico" in valor_x: nivel = "CRÍTICO"
+                elif valor_q == "aceptable": nivel = "ACEPTABLE"
+            if nro in mapa_nro_a_indice:
+                datos["puestos_trabajo_detalle"][mapa_nro_a_indice[nro]]["niveles_riesgo_agentes"][config["nombre_json_agente"]] = nivel
+    for puesto in datos["puestos_trabajo_detalle"]:
+        datos["resumen_global_riesgos_tabla"].append({"nro": puesto.get(normalize_key("N°"), ""), "area": puesto.get(normalize_key("Área de trabajo"), ""), "puesto": puesto.get(normalize_key("Puesto de trabajo"), ""), "tarea": puesto.get(normalize_key("Tareas del puesto"), ""), "niveles_riesgo_agentes": puesto["niveles_riesgo_agentes"]})
+    datos["resumen_global_riesgos_tabla"].sort(key=lambda item: int(str(item["nro"]).split('.')[0]) if str(item["nro"]).replace('.','',1).isdigit() else float('inf'))
+    wb.close()
+    return datos
+
+def _cabe_en_ventanas(n_puestos):
+    # Filas que ocupa el generador en cada hoja frente a la ventana original
+    inicios = {"2": 13, **{num_hoja: config["fila_inicio"] for num_hoja, config in CONFIG_HOJAS_FACTORES.items()}}
+    return all(inicios[hoja] >= inicio and inicios[hoja] + n_puestos <= fin for hoja, (inicio, fin) in VENTANAS_ORIGINALES.items())
+
+def _comparable(datos):
+    datos = copy.deepcopy(datos)
+    for clave in METADATA_VARIABLE:
+        datos["metadata"].pop(clave, None)
+    return datos
+
+def _diferencias(a, b, ruta="", limite=5):
+    # Primeras rutas donde difieren dos estructuras JSON, para el mensaje de error
+    if isinstance(a, dict) and isinstance(b, dict):
+        difs = [d for clave in sorted(set(a) | set(b), key=str) for d in _diferencias(a.get(clave), b.get(clave), f"{ruta}.{clave}", limite)]
+    elif isinstance(a, list) and isinstance(b, list) and len(a) == len(b):
+        difs = [d for i, (x, y) in enumerate(zip(a, b)) for d in _diferencias(x, y, f"{ruta}[{i}]", limite)]
+    else:
+        difs = [] if a == b else [f"{ruta}: {str(a)[:80]!r} != {str(b)[:80]!r}"]
+    return difs[:limite]
+
+def _guardar_editada(contenido_excel, editar):
+    # Abre el .xlsx, aplica editar(wb) y devuelve los bytes guardados (como al editar la matriz en Excel)
+    wb = openpyxl.load_workbook(io.BytesIO(contenido_excel))
+    editar(wb)
+    salida = io.BytesIO()
+    wb.save(salida)
+    return salida.getvalue()
+
+def verificar_lectura_original(ruta_excel, n_puestos):
+    original = _lectura_original(ruta_excel)
+    nueva = excel_a_estructura_json(ruta_excel)
+    if _cabe_en_ventanas(n_puestos):
+        for clave in ("informacion_general", "puestos_trabajo_detalle", "resumen_global_riesgos_tabla"):
+            assert nueva[clave] == original[clave], f"{clave} distinto de la lectura original: {_diferencias(nueva[clave], original[clave])}"
+        return
+    assert nueva["informacion_general"] == original["informacion_general"], "informacion_general distinta de la lectura original"
+    nuevos_por_nro = {puesto[normalize_key("N°")]: puesto for puesto in nueva["puestos_trabajo_detalle"]}
+    for puesto in original["puestos_trabajo_detalle"]:
+        nro = puesto[normalize_key("N°")]
+        assert nro in nuevos_por_nro, f"El puesto {nro} que leía la lectura original no se leyó"
+        campos = {clave: valor for clave, valor in puesto.items() if clave != "niveles_riesgo_agentes"}
+        assert {clave: nuevos_por_nro[nro][clave] for clave in campos} == campos, f"El puesto {nro} se leyó distinto"
+        for agente, nivel in puesto["niveles_riesgo_agentes"].items():
+            assert nivel == "AUSENTE" or nuevos_por_nro[nro]["niveles_riesgo_agentes"][agente] == nivel, f"Nivel de {agente} del puesto {nro}: {nuevos_por_nro[nro]['niveles_riesgo_agentes'][agente]} != {nivel}"
+
+def verificar_niveles_generados(ruta_excel, niveles_esperados):
+    datos = excel_a_estructura_json(ruta_excel)
+    leidos = {str(puesto[normalize_key("N°")]): {agente: nivel for agente, nivel in puesto["niveles_riesgo_agentes"].items() if nivel != "AUSENTE"} for puesto in datos["puestos_trabajo_detalle"]}
+    distintos = [nro for nro in niveles_esperados if leidos.get(nro) != niveles_esperados[nro]]
+    assert len(leidos) == len(niveles_esperados) and not distintos, f"{len(leidos)} puestos leídos de {len(niveles_esperados)}; puestos distintos: {distintos[:10]}"
+
+def verificar_filas_vaciadas(ruta_excel, n_puestos, niveles_esperados, vaciados):
+    # Vacía (sin eliminarlas) las filas de los puestos `vaciados` en las hojas 2 y 5, como quien borra el contenido
+    filas_por_hoja = {"2": FILA_INICIO_HOJA2, "5": CONFIG_HOJAS_FACTORES["5"]["fila_inicio"]}
+    def vaciar(wb):
+        for num_hoja, primera_fila in filas_por_hoja.items():
+            for nro in vaciados:
+                for celda in wb[num_hoja][primera_fila + nro - 1]:
+                    celda.value = None
+    with open(ruta_excel, "rb") as f_excel:
+        contenido_excel = _guardar_editada(f_excel.read(), vaciar)
+    with open(ruta_excel, "wb") as f_excel:
+        f_excel.write(contenido_excel)
+    verificar_lectura_original(ruta_excel, n_puestos)
+    esperados = {nro: niveles for nro, niveles in niveles_esperados.items() if int(nro) not in vaciados}
+    verificar_niveles_generados(ruta_excel, esperados)
+    assert contar_puestos_xlsx(contenido_excel) == len(esperados), f"contar_puestos_xlsx: {contar_puestos_xlsx(contenido_excel)} != {len(esperados)} puestos leídos"
+
+def verificar_incremental(contenido_excel):
+    # Cada caso: (descripción, edición, nombre del archivo nuevo, hojas que deben leerse de nuevo)
+    nro_col, area_col = COL_NRO_PUESTO, COL_NRO_PUESTO + 1
+    fila_nivel_5 = CONFIG_HOJAS_FACTORES["5"]["fila_inicio"] + 2
+    casos = [
+        ("nivel de Postura editado", lambda wb: wb["5"].cell(row=fila_nivel_5, column=CONFIG_HOJAS_FACTORES["5"]["col_q_idx"], value="Aceptable"), "matriz.xlsx", {"5"}),
+        ("área editada en la Hoja 2", lambda wb: wb["2"].cell(row=15, column=area_col, value="Área editada"), "matriz.xlsx", {"2"}),
+        ("puesto eliminado de la Hoja 2", lambda wb: setattr(wb["2"].cell(row=16, column=nro_col), "value", None), "matriz.xlsx", {"2"}), # cell(value=None) no borra
+        ("Hoja 1 editada y archivo renombrado", lambda wb: wb["1"].cell(row=35, column=5, value="Otro responsable"), "matriz_v2.xlsx", {"1"}),
+    ]
+    original = _guardar_editada(contenido_excel, lambda wb: None)
+    for descripcion, editar, nombre_nuevo, hojas_esperadas in casos:
+        cache = CacheLibrosTMERT()
+        excel_a_estructura_json_cacheado(original, "matriz.xlsx", cache)
+        editada = _guardar_editada(contenido_excel, editar)
+        incremental = excel_a_estructura_json_cacheado(editada, nombre_nuevo, cache)
+        reproceso = incremental["metadata"]["reproceso"]
+        assert reproceso["modo"] == "incremental", f"{descripcion}: se esperaba una lectura incremental y fue {reproceso['modo']}"
+        assert hojas_esperadas <= set(reproceso["hojas_leidas"]) and len(reproceso["hojas_leidas"]) < 9, f"{descripcion}: hojas leídas {reproceso['hojas_leidas']}"
+        completa = excel_a_estructura_json(io.BytesIO(editada))
+        assert _comparable(incremental) == _comparable(completa), f"{descripcion}: el resultado incremental difiere de la lectura completa: {_diferencias(_comparable(incremental), _comparable(completa))}"
+
+def verificar_cache(contenido_excel):
+    with tempfile.TemporaryDirectory(prefix="cache_tmert_") as directorio:
+        cache = CacheLibrosTMERT(directorio_disco=directorio)
+        primera = excel_a_estructura_json_cacheado(contenido_excel, "matriz.xlsx", cache, agentes_requeridos=["Postura"])
+        assert primera["metadata"]["reproceso"]["modo"] == "completo" and cache.estadisticas["fallos"] == 1, f"Primera lectura: {primera['metadata']['reproceso']} {cache.estadisticas}"
+        segunda = excel_a_estructura_json_cacheado(contenido_excel, "matriz.xlsx", cache, agentes_requeridos=["Postura"])
+        assert segunda["metadata"]["reproceso"] == {"modo": "cache", "archivo_previo": None, "hojas_modificadas": [], "hojas_leidas": []}, f"Acierto en memoria: {segunda['metadata']['reproceso']}"
+        assert cache.estadisticas["aciertos_memoria"] == 1, f"Acierto en memoria: {cache.estadisticas}"
+        segunda["puestos_trabajo_detalle"].clear() # El llamador modifica su copia; la entrada de la caché no debe cambiar
+        faltantes = excel_a_estructura_json_cacheado(contenido_excel, "matriz.xlsx", cache)
+        assert faltantes["metadata"]["reproceso"]["hojas_leidas"] == [num_hoja for num_hoja in CONFIG_HOJAS_FACTORES if num_hoja != "5"], f"Agentes faltantes: {faltantes['metadata']['reproceso']}"
+        completa = excel_a_estructura_json(io.BytesIO(contenido_excel))
+        assert _comparable(faltantes) == _comparable(completa), f"Agentes agregados desde la caché distintos de la lectura completa: {_diferencias(_comparable(faltantes), _comparable(completa))}"
+
+        en_disco = CacheLibrosTMERT(directorio_disco=directorio) # Otro proceso (o un reinicio): la memoria está vacía
+        desde_disco = excel_a_estructura_json_cacheado(contenido_excel, "matriz.xlsx", en_disco)
+        assert en_disco.estadisticas["aciertos_disco"] == 1 and desde_disco["metadata"]["reproceso"]["modo"] == "cache", f"Acierto en disco: {en_disco.estadisticas}"
+        assert _comparable(desde_disco) == _comparable(completa), "La entrada leída del disco difiere de la lectura completa"
+
+        for nombre in os.listdir(directorio):
+            with open(os.path.join(directorio, nombre), "wb") as f_cache:
+                f_cache.write(b"no es un pickle")
+        danada = CacheLibrosTMERT(directorio_disco=directorio)
+        releida = excel_a_estructura_json_cacheado(contenido_excel, "matriz.xlsx", danada)
+        assert danada.estadisticas["fallos"] == 1 and releida["metadata"]["reproceso"]["modo"] == "completo", f"Caché dañada: {danada.estadisticas} {releida['metadata']['reproceso']}"
+
+        chica = CacheLibrosTMERT(directorio_disco=directorio, max_bytes_disco=1)
+        excel_a_estructura_json_cacheado(_guardar_editada(contenido_excel, lambda wb: None), "otra.xlsx", chica)
+        assert not [nombre for nombre in os.listdir(directorio) if nombre.endswith(".pkl")], "La caché en disco no respetó max_bytes_disco"
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Verifica lectura, lectura incremental y caché del motor TMERT con matrices sintéticas.")
+    parser.add_argument("--puestos", type=int, nargs="+", default=PUESTOS_POR_DEFECTO, help="Tamaños de las matrices para la lectura (por defecto: 10 90 300)")
+    parser.add_argument("--semilla", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    fallas = 0
+    def verificar(nombre, funcion, *argumentos):
+        nonlocal fallas
+        try:
+            funcion(*argumentos)
+            print(f"OK    {nombre}")
+        except Exception as e:
+            fallas += 1
+            print(f"FALLA {nombre}: {e}", file=sys.stderr)
+            if not isinstance(e, AssertionError):
+                traceback.print_exc()
+
+    with tempfile.TemporaryDirectory(prefix="verif_tmert_") as directorio:
+        for n_puestos in args.puestos:
+            ruta_excel = os.path.join(directorio, f"matriz_{n_puestos}.xlsx")
+            niveles_esperados = generar_matriz(ruta_excel, n_puestos, semilla=args.semilla)
+            verificar(f"lectura_original ({n_puestos} puestos)", verificar_lectura_original, ruta_excel, n_puestos)
+            verificar(f"niveles_generados ({n_puestos} puestos)", verificar_niveles_generados, ruta_excel, niveles_esperados)
+        for n_puestos, vaciados in CASOS_FILAS_VACIADAS:
+            ruta_excel = os.path.join(directorio, f"matriz_vaciada_{n_puestos}.xlsx")
+            niveles_esperados = generar_matriz(ruta_excel, n_puestos, semilla=args.semilla)
+            verificar(f"filas_vaciadas ({n_puestos} puestos, N° {vaciados.start} a {vaciados.stop - 1})", verificar_filas_vaciadas, ruta_excel, n_puestos, niveles_esperados, vaciados)
+        ruta_excel = os.path.join(directorio, "matriz_incremental.xlsx")
+        generar_matriz(ruta_excel, 40, semilla=args.semilla)
+        with open(ruta_excel, "rb") as f_excel:
+            contenido_excel = f_excel.read()
+        verificar("incremental", verificar_incremental, contenido_excel)
+        verificar("cache", verificar_cache, contenido_excel)
+    if fallas:
+        print(f"{fallas} verificación(es) fallaron.", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
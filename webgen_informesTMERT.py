@@ -1,200 +1,236 @@
 import streamlit as st
-import openpyxl
-# import pandas as pd # No se usa directamente, se puede quitar si no es dependencia de otra cosa
-import openpyxl.utils # Usado en tu código original, lo mantengo
 import os
-import json
-from datetime import datetime, date # date es necesario para st.date_input
-import traceback
-import re
-from docxtpl import DocxTemplate
-from io import BytesIO
+import threading
+import uuid
+from motor_informesTMERT import (
+    normalize_key, procesar_y_enriquecer_datos, generar_docx_en_memoria,
+    CacheLibrosTMERT, excel_a_estructura_json_cacheado, obtener_registro_plantillas,
+    MAPEO_AGENTE_A_PLANTILLA, NOMBRE_AGENTE_POR_CLAVE, construir_contexto_informe,
+    nombre_archivo_informe, generar_paquete_informes_zip, contar_niveles, obtener_pool_render
+)
+from diagnostico_informesTMERT import configurar_log_diagnostico
+from pdf_informesTMERT import obtener_pool_pdf, pdf_disponible, ErrorConversionPDF
+from cola_informesTMERT import obtener_cola_trabajos, estimar_memoria_mb, ColaLlenaError, ESTADO_EN_COLA, ESTADO_PROCESANDO, ESTADO_ERROR
 
-# --- Función para Normalizar Claves ---
-def normalize_key(text):
-    if not isinstance(text, str):
-        text = str(text)
-    text = text.lower()
-    replacements = {
-        " ": "_", "º": "nro", ".": "", ":": "", "ñ": "n", "ó": "o", "ö": "o",
-        "é": "e", "í": "i", "á": "a", "ú": "u", "ü": "u", "-": "_", "(": "", ")": "",
-        "/": "_"
-    }
-    for char, replacement in replacements.items():
-        text = text.replace(char, replacement)
-    text = re.sub(r'_+', '_', text) # Colapsar múltiples guiones bajos
-    return text.strip("_")
+# --- Interfaz de Usuario y Lógica Principal de Streamlit ---
+def informar_en_streamlit(nivel, mensaje):
+    if nivel == "error":
+        st.error(mensaje)
+    else:
+        st.warning(mensaje)
+
+def mostrar_diagnostico(medicion):
+    # La medición la finaliza el trabajo en su hilo (ver trabajo_informe)
+    with st.expander("🩺 Diagnóstico de rendimiento"):
+        st.dataframe([{"Etapa": "\u00a0\u00a0\u00a0" * registro["nivel"] + registro["etapa"], "Tiempo (ms)": registro["duracion_ms"], **({"Pico memoria (KB)": registro["pico_memoria_kb"]} if medicion.memoria else {})} for registro in medicion.etapas], hide_index=True)
+        st.caption(f"Id de ejecución: {medicion.id_ejecucion}" + (f" · Perfil cProfile: {medicion.ruta_perfil}" if medicion.ruta_perfil else ""))
+        if medicion.memoria and any(registro["pico_memoria_kb"] is None for registro in medicion.etapas):
+            st.caption("Las etapas sin pico de memoria coincidieron con otra generación en curso: tracemalloc es uno solo para todo el servidor y ese pico no sería solo suyo.")
+
+def mostrar_reproceso(reproceso):
+    # Qué hojas se leyeron en esta carga (ver excel_a_estructura_json_cacheado)
+    hojas_leidas = ", ".join(reproceso.get("hojas_leidas", [])) or "ninguna"
+    if reproceso.get("modo") == "incremental":
+        hojas_modificadas = ", ".join(reproceso["hojas_modificadas"]) or "ninguna"
+        st.info(f"🔁 Nueva versión de '{reproceso['archivo_previo']}'. Hojas modificadas: {hojas_modificadas}. Hojas leídas nuevamente: {hojas_leidas}.")
+    elif reproceso.get("modo") == "cache":
+        st.caption(f"♻️ Matriz ya procesada; hojas leídas en esta carga: {hojas_leidas}.")
 
-# --- Función para Procesar y Enriquecer Datos (Cálculos de Totales) ---
-def procesar_y_enriquecer_datos(datos_crudos):
-    if not datos_crudos:
-        return None
-    datos_procesados = datos_crudos.copy() # Trabajar sobre una copia
-    # Calcular total de trabajadores en el centro de trabajo
-    if "informacion_general" in datos_procesados and "centro_trabajo" in datos_procesados["informacion_general"]:
-        ct = datos_procesados["informacion_general"]["centro_trabajo"]
+# --- Trabajos en segundo plano (cola_informesTMERT) ---
+# Corren en un hilo de la cola compartida por todas las sesiones: no pueden usar st.*; los avisos del motor
+# quedan en trabajo.avisos y el avance en trabajo.progreso, y la sesión los muestra con seguir_trabajo().
+def _nueva_medicion_trabajo(trabajo, nombre):
+    # Los tiempos se miden siempre; el pico de memoria solo con TMERT_MEDIR_MEMORIA=1, porque tracemalloc
+    # agrega costo a cada asignación (~1,8 veces más lento el parseo y render)
+    return trabajo.nueva_medicion(nombre, memoria=os.environ.get("TMERT_MEDIR_MEMORIA", "0") == "1")
+
+def _parsear_en_trabajo(trabajo, medicion, contenido_excel, nombre_excel, cache_libros, ambito, agentes_requeridos):
+    with medicion.etapa("parseo"):
+        datos_crudos_json = excel_a_estructura_json_cacheado(contenido_excel, nombre_excel, cache_libros, agentes_requeridos=agentes_requeridos, informar=trabajo.informar, medicion=medicion, ambito=ambito)
+    if not datos_crudos_json:
+        raise ValueError("No se pudo procesar el archivo Excel.")
+    return datos_crudos_json
+
+def trabajo_informe(trabajo, contenido_excel, nombre_excel, agente, datos_manuales, cache_libros, ambito, pool_pdf=None):
+    medicion = _nueva_medicion_trabajo(trabajo, "informe")
+    try:
+        datos_crudos_json = _parsear_en_trabajo(trabajo, medicion, contenido_excel, nombre_excel, cache_libros, ambito, {agente})
+        with medicion.etapa("enriquecimiento"):
+            datos_enriquecidos = procesar_y_enriquecer_datos(datos_crudos_json)
+        with medicion.etapa("filtro", agente=agente):
+            contexto_final = construir_contexto_informe(datos_enriquecidos, agente, datos_manuales)
+        ruta_plantilla_en_repo = MAPEO_AGENTE_A_PLANTILLA.get(normalize_key(agente))
+        if not ruta_plantilla_en_repo:
+            raise ValueError(f"No se encontró una plantilla mapeada para el agente: '{agente}'. Verifica el diccionario 'MAPEO_AGENTE_A_PLANTILLA' y los archivos en 'plantillas/'.")
         try:
-            hombres_ct = int(ct.get("nnro_trabajadores_hombres", 0) or 0)
-            mujeres_ct = int(ct.get("nnro_trabajadores_mujeres", 0) or 0)
-            ct["total_trabajadores_ct"] = hombres_ct + mujeres_ct
-        except ValueError:
-            ct["total_trabajadores_ct"] = "N/A (Error conversión)"
-    # Calcular total de trabajadores expuestos por cada puesto/caso
-    if "puestos_trabajo_detalle" in datos_procesados:
-        for puesto in datos_procesados["puestos_trabajo_detalle"]:
+            with medicion.etapa("cargar_plantilla", plantilla=ruta_plantilla_en_repo):
+                plantilla_seleccionada = obtener_registro_plantillas().nueva_instancia(ruta_plantilla_en_repo)
+            with medicion.etapa("generar_docx"):
+                informe_bytes = generar_docx_en_memoria(plantilla_seleccionada, contexto_final, informar=trabajo.informar, medicion=medicion)
+        except FileNotFoundError as e:
+            raise RuntimeError(f"Error crítico: No se encontró la plantilla '{ruta_plantilla_en_repo}' en el repositorio. Verifica que el archivo exista en la carpeta 'plantillas' y que el nombre en el mapeo sea exacto.") from e
+        except Exception as e:
+            raise RuntimeError(f"Error al cargar o procesar la plantilla específica: {e}") from e
+        if not informe_bytes:
+            raise RuntimeError("No se pudo generar el informe Word con la plantilla seleccionada.")
+        informe_pdf, error_pdf = None, None
+        if pool_pdf is not None:
             try:
-                hombres_exp = int(puesto.get(normalize_key("N° trab exp hombre"), 0) or 0) # Usar clave normalizada
-                mujeres_exp = int(puesto.get(normalize_key("N° trab exp mujer"), 0) or 0) # Usar clave normalizada
-                puesto["total_trabajadores_expuestos_puesto"] = hombres_exp + mujeres_exp
-            except ValueError:
-                puesto["total_trabajadores_expuestos_puesto"] = "N/A (Error conversión)"
-            except TypeError:
-                 puesto["total_trabajadores_expuestos_puesto"] = "N/A (Error tipo)"
-    return datos_procesados
+                with medicion.etapa("convertir_pdf"):
+                    informe_pdf = pool_pdf.convertir(informe_bytes)
+            except ErrorConversionPDF as e_pdf:
+                error_pdf = str(e_pdf)
+        return {
+            "agente": agente,
+            "reproceso": datos_crudos_json["metadata"].get("reproceso", {}),
+            "extension_hojas": datos_crudos_json["metadata"].get("extension_hojas", {}),
+            "estadisticas_cache": dict(cache_libros.estadisticas),
+            "n_puestos": len(contexto_final["puestos_trabajo_detalle"]),
+            "conteo_niveles": contar_niveles(datos_enriquecidos, agentes=[agente]).get(normalize_key(agente), {}),
+            "docx": informe_bytes.getvalue(),
+            "nombre_docx": nombre_archivo_informe(nombre_excel, datos_manuales["numero_informe_tecnico"], agente),
+            "pdf": informe_pdf,
+            "nombre_pdf": nombre_archivo_informe(nombre_excel, datos_manuales["numero_informe_tecnico"], agente, extension="pdf"),
+            "error_pdf": error_pdf
+        }
+    finally:
+        medicion.finalizar()
 
-# --- Función para Generar el DOCX en memoria ---
-def generar_docx_en_memoria(plantilla_bytes_io, contexto_render):
+def trabajo_paquete(trabajo, contenido_excel, nombre_excel, datos_manuales, cache_libros, ambito, pool_pdf=None):
+    medicion = _nueva_medicion_trabajo(trabajo, "paquete")
     try:
-        doc = DocxTemplate(plantilla_bytes_io)
-        doc.render(contexto_render)
-        file_stream = BytesIO()
-        doc.save(file_stream)
-        file_stream.seek(0)
-        return file_stream
-    except Exception as e:
-        st.error(f"Error al generar el documento Word: {e}")
-        traceback.print_exc()
-        return None
+        agentes_con_plantilla = [NOMBRE_AGENTE_POR_CLAVE[clave_agente] for clave_agente in MAPEO_AGENTE_A_PLANTILLA]
+        datos_crudos_json = _parsear_en_trabajo(trabajo, medicion, contenido_excel, nombre_excel, cache_libros, ambito, agentes_con_plantilla)
+        with medicion.etapa("enriquecimiento"):
+            datos_enriquecidos = procesar_y_enriquecer_datos(datos_crudos_json)
+        with medicion.etapa("paquete_zip", informes=len(MAPEO_AGENTE_A_PLANTILLA)):
+            paquete_zip, resultados_paquete = generar_paquete_informes_zip(datos_enriquecidos, datos_manuales, nombre_excel, convertidor_pdf=pool_pdf)
+        return {
+            "reproceso": datos_crudos_json["metadata"].get("reproceso", {}),
+            "resultados_paquete": resultados_paquete,
+            "zip": paquete_zip,
+            "nombre_zip": os.path.splitext(nombre_archivo_informe(nombre_excel, datos_manuales["numero_informe_tecnico"], "todos"))[0] + ".zip"
+        }
+    finally:
+        medicion.finalizar()
 
-# --- Función para Procesar el Excel a la Estructura JSON ---
-def excel_a_estructura_json(uploaded_excel_file):
-    if uploaded_excel_file is None:
-        return None
+def enviar_trabajo(clave_sesion, tipo, funcion, uploaded_excel, informes, *args):
+    # Encola el trabajo y guarda su id en la sesión; un envío nuevo reemplaza (y libera) el anterior de la misma clave
+    cola = obtener_cola_trabajos()
+    if st.session_state.get(clave_sesion):
+        cola.liberar(st.session_state.pop(clave_sesion))
+    contenido_excel = uploaded_excel.getvalue()
     try:
-        wb = openpyxl.load_workbook(uploaded_excel_file, data_only=True)
-    except Exception as e:
-        st.error(f"Error al abrir el archivo Excel: {e}")
-        traceback.print_exc()
-        return None
+        trabajo = cola.enviar(tipo, funcion, contenido_excel, uploaded_excel.name, *args, memoria_estimada_mb=estimar_memoria_mb(contenido_excel, informes))
+    except ColaLlenaError as e:
+        st.error(f"❌ {e}")
+        return
+    st.session_state[clave_sesion] = trabajo.id
 
-    datos_para_json = {
-        "metadata": {
-            "nombre_archivo_original": uploaded_excel_file.name if hasattr(uploaded_excel_file, 'name') else "archivo_excel_cargado.xlsx",
-            "fecha_procesamiento": datetime.now().isoformat()
-        },
-        "informacion_general": {
-            "antecedentes_empresa": {},
-            "centro_trabajo": {},
-            "responsable_protocolo": {}
-        },
-        "puestos_trabajo_detalle": [],
-        "resumen_global_riesgos_tabla": []
-    }
-    mapa_nro_puesto_a_indice_json = {}
-    agentes_riesgo_ordenados = [
-        "Repetitividad", "Postura", "MMC LDT", "MMC EA",
-        "MMP", "Vibración MB", "Vibración CC"
-    ]
+def _panel_trabajo(clave_sesion, mostrar_resultado, en_curso):
+    cola = obtener_cola_trabajos()
+    trabajo = cola.obtener(st.session_state.get(clave_sesion))
+    if trabajo is None:
+        st.caption("✔️ Resultado ya descargado o vencido.")
+        return
+    if trabajo.estado == ESTADO_EN_COLA:
+        estado_cola = cola.estado_general()
+        st.info(f"⏳ En cola: posición {cola.posicion(trabajo)} de {estado_cola['en_espera']} · {estado_cola['procesando']} de {estado_cola['max_concurrentes']} trabajos en proceso.")
+    elif trabajo.estado == ESTADO_PROCESANDO:
+        st.progress(trabajo.fraccion, text=f"⚙️ {trabajo.progreso}...")
+    elif en_curso:
+        st.rerun() # Terminó: se redibuja la app completa, que ya no consulta cada segundo
+    else:
+        for nivel, mensaje in trabajo.avisos:
+            informar_en_streamlit(nivel, mensaje)
+        if trabajo.estado == ESTADO_ERROR:
+            st.error(f"❌ {trabajo.error}")
+        elif trabajo.resultado is not None:
+            mostrar_resultado(trabajo)
+        if trabajo.medicion is not None:
+            mostrar_diagnostico(trabajo.medicion)
 
-    # Procesamiento Hoja 1
-    mapeo_hoja1 = {
-        "1. ANTECEDENTES DE LA EMPRESA": {"Razón Social": (15, 'E'), "RUT Empresa": (15, 'L'), "Actividad Económica": (17, 'E'), "Código CIIU": (17, 'L'), "Dirección": (19, 'E'), "Comuna": (19, 'L'), "Nombre Representante Legal": (21, 'E'), "Organismo administrador al que está adherido": (23, 'E'), "Fecha inicio": (23, 'L')},
-        "2. CENTRO DE TRABAJO O LUGAR DE TRABAJO": {"Nombre del centro de trabajo": (27, 'E'), "Dirección": (29, 'E'), "Comuna": (29, 'L'), "Nº Trabajadores Hombres": (31, 'G'), "Nº Trabajadores Mujeres": (31, 'L')},
-        "3. RESPONSABLE IMPLEMENTACIÓN PROTOCOLO": {"Nombre responsable": (35, 'E'), "Cargo": (37, 'E'), "Correo electrónico": (39, 'E'), "Teléfono": (39, 'L')}
-    }
-    try:
-        hoja1_openpyxl = wb["1"]
-        # st.write("[INFO Hoja 1] Leyendo Hoja 1.") # Descomentar para depurar en Streamlit
-        for seccion_titulo, campos in mapeo_hoja1.items():
-            for etiqueta, (fila_excel, col_excel_char) in campos.items():
-                valor_crudo_h1 = hoja1_openpyxl[f"{col_excel_char}{fila_excel}"].value
-                valor_str_h1 = str(valor_crudo_h1).strip() if valor_crudo_h1 is not None and str(valor_crudo_h1).strip() != "0" else ""
-                if valor_str_h1:
-                    clave_json = normalize_key(etiqueta)
-                    if seccion_titulo == "1. ANTECEDENTES DE LA EMPRESA":
-                        datos_para_json["informacion_general"]["antecedentes_empresa"][clave_json] = valor_str_h1
-                    elif seccion_titulo == "2. CENTRO DE TRABAJO O LUGAR DE TRABAJO":
-                        datos_para_json["informacion_general"]["centro_trabajo"][clave_json] = valor_str_h1
-                    elif seccion_titulo == "3. RESPONSABLE IMPLEMENTACIÓN PROTOCOLO":
-                        datos_para_json["informacion_general"]["responsable_protocolo"][clave_json] = valor_str_h1
-    except KeyError: st.warning("Advertencia: No se encontró la Hoja '1' en el Excel. Se omitirá esta sección.")
-    except Exception as e: st.error(f"Error procesando Hoja '1' del Excel: {e}"); traceback.print_exc()
+def seguir_trabajo(clave_sesion, mostrar_resultado):
+    # Mientras el trabajo esté en cola o procesando, solo este panel se vuelve a ejecutar cada segundo
+    if not st.session_state.get(clave_sesion):
+        return
+    trabajo = obtener_cola_trabajos().obtener(st.session_state[clave_sesion])
+    if trabajo is not None and trabajo.estado in (ESTADO_EN_COLA, ESTADO_PROCESANDO):
+        st.fragment(_panel_trabajo, run_every=1)(clave_sesion, mostrar_resultado, True)
+    else:
+        _panel_trabajo(clave_sesion, mostrar_resultado, False)
 
-    # Procesamiento Hoja 2
-    COL_NRO_H2, COL_AREA_H2, COL_PUESTO_H2 = 2, 3, 4 # Columnas B, C, D
-    try:
-        hoja2 = wb["2"]
-        hoja2_headers = ["N°", "Área de trabajo", "Puesto de trabajo", "Tareas del puesto", "Descripción de la tarea", "Horario de funcionamiento", "HHEX dia", "HHEX sem", "N° trab exp hombre", "N° trab exp mujer", "Tipo contrato", "Tipo remuneracion", "Duración (min)", "Pausas", "Rotación", "Equipos - Herramientas", "Características ambientes - espacios trabajo", "Características disposición espacial puesto", "Características herramientas"]
-        # st.write("[INFO Hoja 2] Leyendo Hoja 2.")
-        for fila_idx in range(13, 114): # Rango de filas a leer
-            nro_puesto_val = str(hoja2.cell(row=fila_idx, column=COL_NRO_H2).value or "").strip()
-            val_a_obj = hoja2.cell(row=fila_idx, column=COL_AREA_H2).value
-            val_p_obj = hoja2.cell(row=fila_idx, column=COL_PUESTO_H2).value
-            val_a_str = str(val_a_obj).strip() if val_a_obj is not None else ""
-            val_p_str = str(val_p_obj).strip() if val_p_obj is not None else ""
-            if not (nro_puesto_val and nro_puesto_val != "0" and val_a_str and val_a_str != "0" and val_p_str and val_p_str != "0"): continue
-            current_row_values = [str(hoja2.cell(row=fila_idx, column=col_idx).value or "") for col_idx in range(COL_NRO_H2, COL_NRO_H2 + len(hoja2_headers))]
-            if any(val.strip() for val in current_row_values):
-                puesto_detalle_json = {normalize_key(hoja2_headers[i]): current_row_values[i] for i in range(len(hoja2_headers)) if i < len(current_row_values)}
-                puesto_detalle_json["niveles_riesgo_agentes"] = {normalize_key(agente): "AUSENTE" for agente in agentes_riesgo_ordenados}
-                datos_para_json["puestos_trabajo_detalle"].append(puesto_detalle_json)
-                mapa_nro_puesto_a_indice_json[nro_puesto_val] = len(datos_para_json["puestos_trabajo_detalle"]) - 1
-    except KeyError: st.warning("Advertencia: No se encontró la Hoja '2' en el Excel. Se omitirá la caracterización de puestos.")
-    except Exception as e: st.error(f"Error procesando Hoja '2' del Excel: {e}"); traceback.print_exc()
+def mostrar_resultado_informe(trabajo):
+    resultado = trabajo.resultado
+    estadisticas_cache = resultado["estadisticas_cache"]
+    st.caption(f"Caché de libros: {estadisticas_cache['aciertos_memoria']} aciertos en memoria, {estadisticas_cache['aciertos_disco']} en disco, {estadisticas_cache['fallos']} fallos.")
+    mostrar_reproceso(resultado["reproceso"])
+    st.success("✅ Estructura JSON generada.")
+    st.caption(" · ".join(f"Hoja {hoja}: {ext['filas_con_datos']} filas con datos de {ext['filas_leidas']} leídas ({ext['filas_omitidas']} omitidas)" for hoja, ext in resultado["extension_hojas"].items()))
+    st.info(f"📊 Filtro aplicado: Se incluirán {resultado['n_puestos']} puestos con riesgo de {resultado['agente']} INTERMEDIO.")
+    st.caption(f"Puestos por nivel de {resultado['agente']}: " + " · ".join(f"{nivel}: {cantidad}" for nivel, cantidad in sorted(resultado["conteo_niveles"].items())))
+    # El resultado se guarda en la cola hasta que se descargan todos sus archivos
+    archivos = ["docx"] + (["pdf"] if resultado["pdf"] is not None else [])
+    st.download_button(
+        label=f"📥 Descargar Informe ({resultado['agente']} INTERMEDIO)",
+        data=resultado["docx"],
+        file_name=resultado["nombre_docx"],
+        mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+        key="download_button_final_mapeado",
+        on_click=obtener_cola_trabajos().marcar_descargado, args=(trabajo.id, "docx", archivos)
+    )
+    st.success("🎉 ¡Informe Word generado!")
+    if resultado["pdf"] is not None:
+        st.download_button(
+            label=f"📥 Descargar PDF ({resultado['agente']} INTERMEDIO)",
+            data=resultado["pdf"],
+            file_name=resultado["nombre_pdf"],
+            mime="application/pdf",
+            key="download_button_pdf",
+            on_click=obtener_cola_trabajos().marcar_descargado, args=(trabajo.id, "pdf", archivos)
+        )
+    elif resultado["error_pdf"]:
+        st.error(f"❌ No se pudo convertir el informe a PDF: {resultado['error_pdf']}")
 
-    # Procesamiento Hojas de Factores
-    config_hojas_factores = {
-        "4": {"nombre_json_agente": normalize_key(agentes_riesgo_ordenados[0]), "col_q_idx": 17, "col_x_idx": 24, "r_filas": (14, 116)},
-        "5": {"nombre_json_agente": normalize_key(agentes_riesgo_ordenados[1]), "col_q_idx": 31, "col_x_idx": 49, "r_filas": (17, 116)},
-        "6": {"nombre_json_agente": normalize_key(agentes_riesgo_ordenados[2]), "col_q_idx": 33, "col_x_idx": 56, "r_filas": (18, 118)},
-        "7": {"nombre_json_agente": normalize_key(agentes_riesgo_ordenados[3]), "col_q_idx": 24, "col_x_idx": 41, "r_filas": (17, 117)},
-        "8": {"nombre_json_agente": normalize_key(agentes_riesgo_ordenados[4]), "col_q_idx": 25, "col_x_idx": 41, "r_filas": (17, 117)},
-        "9": {"nombre_json_agente": normalize_key(agentes_riesgo_ordenados[5]), "col_riesgo_directo_idx": 19, "r_filas": (16, 116)}, # Vibración MB
-        "10": {"nombre_json_agente": normalize_key(agentes_riesgo_ordenados[6]), "col_riesgo_directo_idx": 22, "r_filas": (16, 116)}  # Vibración CC
-    }
-    for num_hoja_str, config in config_hojas_factores.items():
-        try:
-            hoja_actual = wb[num_hoja_str]
-            # st.write(f"[INFO Hoja {num_hoja_str}] Leyendo Hoja {num_hoja_str} - Agente: {config['nombre_json_agente']}.")
-            COL_NRO_FACTOR, COL_AREA_FACTOR, COL_PUESTO_FACTOR = 2, 3, 4
-            for fila_idx in range(config["r_filas"][0], config["r_filas"][1]):
-                nro_puesto_riesgo = str(hoja_actual.cell(row=fila_idx, column=COL_NRO_FACTOR).value or "").strip()
-                val_a_obj = hoja_actual.cell(row=fila_idx, column=COL_AREA_FACTOR).value
-                val_p_obj = hoja_actual.cell(row=fila_idx, column=COL_PUESTO_FACTOR).value
-                val_a_str = str(val_a_obj).strip() if val_a_obj is not None else ""
-                val_p_str = str(val_p_obj).strip() if val_p_obj is not None else ""
-                if not (nro_puesto_riesgo and nro_puesto_riesgo != "0" and val_a_str and val_a_str != "0" and val_p_str and val_p_str != "0"): continue
-                risk_level_text = "No Determinado"
-                if "col_riesgo_directo_idx" in config:
-                    valor_crudo = hoja_actual.cell(row=fila_idx, column=config["col_riesgo_directo_idx"]).value
-                    valor_str_norm = str(valor_crudo).strip().lower() if valor_crudo is not None else ""
-                    if valor_str_norm == "aceptable": risk_level_text = "ACEPTABLE"
-                    elif valor_str_norm == "no aceptable": risk_level_text = "CRÍTICO"
-                    elif valor_str_norm: risk_level_text = str(valor_crudo).strip().upper()
-                else:
-                    valor_q_crudo = hoja_actual.cell(row=fila_idx, column=config["col_q_idx"]).value
-                    valor_q_str = str(valor_q_crudo).strip().lower() if valor_q_crudo is not None else ""
-                    if valor_q_str == "no aceptable":
-                        valor_x_crudo = hoja_actual.cell(row=fila_idx, column=config["col_x_idx"]).value
-                        valor_x_str = str(valor_x_crudo).strip().lower() if valor_x_crudo is not None else ""
-                        if "no crítico" in valor_x_str or "intermedio" in valor_x_str: risk_level_text = "INTERMEDIO"
-                        elif "crítico" in valor_x_str: risk_level_text = "CRÍTICO"
-                    elif valor_q_str == "aceptable": risk_level_text = "ACEPTABLE"
-                if nro_puesto_riesgo in mapa_nro_puesto_a_indice_json:
-                    indice_puesto = mapa_nro_puesto_a_indice_json[nro_puesto_riesgo]
-                    datos_para_json["puestos_trabajo_detalle"][indice_puesto]["niveles_riesgo_agentes"][config["nombre_json_agente"]] = risk_level_text
-                # else:
-                    # st.warning(f"Advertencia: N° de puesto '{nro_puesto_riesgo}' de Hoja {num_hoja_str} (Agente: {config['nombre_json_agente']}) no encontrado en caracterizaciones de Hoja 2.")
-        except KeyError: st.warning(f"Advertencia: No se encontró la Hoja '{num_hoja_str}' en el Excel. Se omitirá este factor de riesgo.")
-        except Exception as e: st.error(f"Error procesando Hoja '{num_hoja_str}' del Excel: {e}"); traceback.print_exc()
+def mostrar_resultado_paquete(trabajo):
+    resultado = trabajo.resultado
+    mostrar_reproceso(resultado["reproceso"])
+    for agente, n_puestos, error, error_pdf in resultado["resultados_paquete"]:
+        if error:
+            st.error(f"❌ {agente}: no se pudo generar el informe ({error}).")
+        else:
+            st.info(f"📊 {agente}: {n_puestos} puestos con riesgo INTERMEDIO.")
+        if error_pdf:
+            st.error(f"❌ {agente}: no se pudo convertir el informe a PDF ({error_pdf}).")
+    st.download_button(
+        label="📥 Descargar Todos los Informes (ZIP)",
+        data=resultado["zip"],
+        file_name=resultado["nombre_zip"],
+        mime="application/zip",
+        key="download_button_paquete_zip",
+        on_click=obtener_cola_trabajos().marcar_descargado, args=(trabajo.id, "zip", ["zip"])
+    )
 
-    for puesto_detalle in datos_para_json["puestos_trabajo_detalle"]:
-        item_resumen = {"nro": puesto_detalle.get(normalize_key("N°"), ""), "area": puesto_detalle.get(normalize_key("Área de trabajo"), ""), "puesto": puesto_detalle.get(normalize_key("Puesto de trabajo"), ""), "tarea": puesto_detalle.get(normalize_key("Tareas del puesto"), ""), "niveles_riesgo_agentes": puesto_detalle.get("niveles_riesgo_agentes", {})}
-        datos_para_json["resumen_global_riesgos_tabla"].append(item_resumen)
-    datos_para_json["resumen_global_riesgos_tabla"] = sorted(datos_para_json["resumen_global_riesgos_tabla"], key=lambda item: int(str(item["nro"]).split('.')[0]) if str(item["nro"]).replace('.','',1).isdigit() else float('inf'))
-    return datos_para_json
+configurar_log_diagnostico()
+
+@st.cache_resource
+def obtener_cache_libros():
+    # Una sola caché por proceso, compartida entre reruns y sesiones. TMERT_CACHE_DIR activa el nivel en disco.
+    return CacheLibrosTMERT(directorio_disco=os.environ.get("TMERT_CACHE_DIR") or None)
+
+def id_sesion():
+    # Ámbito del registro de versiones de la caché: cada sesión solo ve sus propias matrices anteriores
+    if "id_sesion" not in st.session_state:
+        st.session_state["id_sesion"] = uuid.uuid4().hex
+    return st.session_state["id_sesion"]
+
+@st.cache_resource
+def obtener_pool_pdf_app():
+    # Los soffice del pool se comparten entre sesiones; se arrancan en segundo plano la primera vez que se pide PDF
+    pool_pdf = obtener_pool_pdf()
+    threading.Thread(target=pool_pdf.precalentar, daemon=True).start()
+    return pool_pdf
 
-# --- Interfaz de Usuario y Lógica Principal de Streamlit ---
 st.set_page_config(page_title='Generador Informes Ev. Inicial Cuantitativa "pre-borrador" PROTOCOLO TMERT', layout="wide") # Corregido
 st.title("Generador Informes Ev. Inicial Cuantitativa \"pre-borrador\" PROTOCOLO TMERT 📄 - Desarrollado por Mauricio Reyes González") # Corregido
 
@@ -226,106 +262,49 @@ with col_manual:
     comite_paritario = st.selectbox("Comité Paritario:", options=opciones_si_no, key="comite_par")
     experto_prevencion = st.selectbox("Experto en prevención:", options=opciones_si_no, key="exp_prev")
 
+datos_manuales = {
+    'numero_informe_tecnico': numero_informe,
+    'nombre_ergonomo': nombre_ergonomo,
+    'rut_ergonomo': rut_ergonomo,
+    'correo_ergonomo': correo_ergonomo,
+    'fecha_visita_empresa': fecha_visita_empresa_input.strftime("%d-%m-%Y") if fecha_visita_empresa_input else "",
+    'horas_semanales_experto_empresa': horas_semanales_experto,
+    'fecha_inicio_ct': fecha_inicio_ct_input.strftime("%d-%m-%Y") if fecha_inicio_ct_input else "",
+    'fecha_termino_conocido_ct': fecha_termino_conocido_ct_input.strftime("%d-%m-%Y") if fecha_termino_conocido_ct_input else "",
+    'fecha_termino_informe': fecha_termino_informe_input.strftime("%d-%m-%Y") if fecha_termino_informe_input else "",
+    'reglamento_hs': reglamento_hs,
+    'depto_preventivo': depto_preventivo,
+    'rol_empresa_en_ct': rol_empresa_ct,
+    'comite_paritario': comite_paritario,
+    'experto_en_prevencion': experto_prevencion
+}
+
 with col_accion:
     st.subheader("3. Generar Informe ⚙️")
     agente_seleccionado_filtro = st.selectbox(
         'Filtrar por Factor de Riesgo (Nivel de riesgo "INTERMEDIO-NO CRÍTICO"):', # Corregido
         options=agentes_para_filtro, index=0, key="agente_filtro"
     )
-    
-    MAPEO_AGENTE_A_PLANTILLA = {
-        normalize_key("Repetitividad"): "plantillas/1_ART.docx",     # CONFIRMA ESTE NOMBRE DE ARCHIVO
-        normalize_key("Postura"): "plantillas/2_REBA.docx",           # CONFIRMA ESTE NOMBRE DE ARCHIVO
-        normalize_key("MMC LDT"): "plantillas/3_MAC.docx",
-        normalize_key("MMC EA"): "plantillas/4_RAPP.docx",
-        # normalize_key("MMP"): "plantillas/plantilla_mmp.docx",       # DESCOMENTA Y AJUSTA CUANDO TENGAS ESTA PLANTILLA
-        # normalize_key("Vibración MB"): "plantillas/plantilla_vibracion_mb.docx",
-        # normalize_key("Vibración CC"): "plantillas/plantilla_vibracion_cc.docx"
-    }
+    generar_pdf = st.checkbox("📑 Generar también PDF", key="generar_pdf", disabled=not pdf_disponible(), help="Requiere LibreOffice y su módulo 'uno' en el servidor.")
+    obtener_registro_plantillas().precargar(MAPEO_AGENTE_A_PLANTILLA.values()) # Solo compila la primera vez o si cambió el archivo
+    obtener_pool_render() # Crea (con fork) los procesos que renderizan el ZIP, o los rehace si un trabajo descartó el pool; no espera a los hijos
+    if generar_pdf:
+        obtener_pool_pdf_app()
     
     if st.button(f"🚀 Procesar y Generar Informe", key="generate_button"):
         if uploaded_excel:
-            with st.spinner("⚙️ Procesando Excel..."):
-                datos_crudos_json = excel_a_estructura_json(uploaded_excel)
-            
-            if datos_crudos_json:
-                st.success("✅ Estructura JSON generada.")
-                with st.spinner("🔍 Aplicando cálculos y filtros..."):
-                    datos_enriquecidos = procesar_y_enriquecer_datos(datos_crudos_json)
-                    clave_agente_filtro_json = normalize_key(agente_seleccionado_filtro)
-                    puestos_originales = datos_enriquecidos.get('puestos_trabajo_detalle', [])
-                    resumen_original = datos_enriquecidos.get('resumen_global_riesgos_tabla', [])
-                    puestos_filtrados = [puesto for puesto in puestos_originales if puesto.get('niveles_riesgo_agentes', {}).get(clave_agente_filtro_json) == 'INTERMEDIO']
-                    numeros_puestos_filtrados = {puesto.get(normalize_key('N°')) for puesto in puestos_filtrados} # Asegúrate que la clave 'N°' se normalice igual que en puestos_detalle
-                    resumen_filtrado = [resumen for resumen in resumen_original if resumen.get('nro') in numeros_puestos_filtrados]
-                    st.info(f"📊 Filtro aplicado: Se incluirán {len(puestos_filtrados)} puestos con riesgo de {agente_seleccionado_filtro} INTERMEDIO.")
-
-                    contexto_final = {
-                        'metadata': datos_enriquecidos.get('metadata', {}),
-                        'informacion_general': datos_enriquecidos.get('informacion_general', {}),
-                        'puestos_trabajo_detalle': puestos_filtrados,
-                        'resumen_global_riesgos_tabla': resumen_filtrado,
-                        'fecha_actual_reporte': datetime.now().strftime("%d-%m-%Y"), # Cambiado formato de fecha
-                        'numero_informe_tecnico': numero_informe,
-                        'nombre_ergonomo': nombre_ergonomo,
-                        'rut_ergonomo': rut_ergonomo,
-                        'correo_ergonomo': correo_ergonomo,
-                        'fecha_visita_empresa': fecha_visita_empresa_input.strftime("%d-%m-%Y") if fecha_visita_empresa_input else "",
-                        'horas_semanales_experto_empresa': horas_semanales_experto,
-                        'fecha_inicio_ct': fecha_inicio_ct_input.strftime("%d-%m-%Y") if fecha_inicio_ct_input else "",
-                        'fecha_termino_conocido_ct': fecha_termino_conocido_ct_input.strftime("%d-%m-%Y") if fecha_termino_conocido_ct_input else "",
-                        'fecha_termino_informe': fecha_termino_informe_input.strftime("%d-%m-%Y") if fecha_termino_informe_input else "",
-                        'reglamento_hs': reglamento_hs,
-                        'depto_preventivo': depto_preventivo,
-                        'rol_empresa_en_ct': rol_empresa_ct,
-                        'comite_paritario': comite_paritario,
-                        'experto_en_prevencion': experto_prevencion
-                    }
-                
-                nombre_agente_norm_para_plantilla = normalize_key(agente_seleccionado_filtro)
-                ruta_plantilla_en_repo = MAPEO_AGENTE_A_PLANTILLA.get(nombre_agente_norm_para_plantilla)
+            enviar_trabajo("trabajo_informe", "informe", trabajo_informe, uploaded_excel, 1, agente_seleccionado_filtro, datos_manuales, obtener_cache_libros(), id_sesion(), obtener_pool_pdf_app() if generar_pdf else None)
+        else:
+            st.warning("⚠️ Por favor, carga el archivo Excel.")
+    seguir_trabajo("trabajo_informe", mostrar_resultado_informe)
 
-                if not ruta_plantilla_en_repo:
-                    st.error(f"❌ No se encontró una plantilla mapeada para el agente: '{agente_seleccionado_filtro}'. Verifica el diccionario 'MAPEO_AGENTE_A_PLANTILLA' y los archivos en 'plantillas/'.")
-                else:
-                    with st.spinner(f"📄 Cargando plantilla '{ruta_plantilla_en_repo}' y generando informe Word..."):
-                        try:
-                            with open(ruta_plantilla_en_repo, "rb") as f_template:
-                                plantilla_bytes_seleccionada = BytesIO(f_template.read())
-                            
-                            informe_bytes = generar_docx_en_memoria(plantilla_bytes_seleccionada, contexto_final)
-                            
-                            if informe_bytes:
-                                base_name_excel = os.path.splitext(uploaded_excel.name)[0]
-                                num_informe_para_nombre = numero_informe.strip()
-                                
-                                if num_informe_para_nombre:
-                                    prefijo_nombre = f"IT_TMERT_{num_informe_para_nombre.replace('/', '_').replace(' ', '_')}"
-                                else:
-                                    nombre_excel_limpio = base_name_excel.replace(' ', '_')
-                                    prefijo_nombre = f"IT_TMERT_{nombre_excel_limpio}"
-                                
-                                nombre_archivo_salida = f"borrador_{prefijo_nombre}_{agente_seleccionado_filtro.replace(' ','_')}.docx"
-                                
-                                st.download_button(
-                                    label=f"📥 Descargar Informe ({agente_seleccionado_filtro} INTERMEDIO)",
-                                    data=informe_bytes,
-                                    file_name=nombre_archivo_salida,
-                                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                                    key="download_button_final_mapeado"
-                                )
-                                st.success("🎉 ¡Informe Word generado!")
-                            else:
-                                st.error("❌ No se pudo generar el informe Word con la plantilla seleccionada.")
-                        except FileNotFoundError:
-                            st.error(f"❌ Error crítico: No se encontró la plantilla '{ruta_plantilla_en_repo}' en el repositorio. Verifica que el archivo exista en la carpeta 'plantillas' y que el nombre en el mapeo sea exacto.")
-                        except Exception as e_template_proc:
-                            st.error(f"❌ Error al cargar o procesar la plantilla específica: {e_template_proc}")
-                            traceback.print_exc()
-            else:
-                st.error("❌ No se pudo procesar el archivo Excel.")
+    st.markdown("---")
+    if st.button("📦 Generar Todos los Informes (ZIP)", key="generate_all_button"):
+        if uploaded_excel:
+            enviar_trabajo("trabajo_paquete", "paquete", trabajo_paquete, uploaded_excel, len(MAPEO_AGENTE_A_PLANTILLA), datos_manuales, obtener_cache_libros(), id_sesion(), obtener_pool_pdf_app() if generar_pdf else None)
         else:
             st.warning("⚠️ Por favor, carga el archivo Excel.")
+    seguir_trabajo("trabajo_paquete", mostrar_resultado_paquete)
 
 # Opcional: Mostrar el JSON procesado para depuración
 # if 'contexto_final' in locals() and contexto_final: # Verificar si contexto_final existe y no es None